@@ -0,0 +1,96 @@
+from bisect import bisect_right
+from collections import defaultdict
+from datetime import date, datetime, time, timedelta
+from itertools import accumulate
+from typing import Dict, Hashable, Iterable, Iterator, List, Tuple
+
+
+def week_start(day: date) -> date:
+    return day - timedelta(days=day.weekday())
+
+
+def split_days(start: datetime, end: datetime) -> Iterator[Tuple[date, timedelta]]:
+    """
+    Split a span at each midnight it crosses
+    """
+    day = start.date()
+    while start < end:
+        midnight = datetime.combine(day + timedelta(days=1), time())
+        part_end = min(end, midnight)
+        yield day, part_end - start
+        start = part_end
+        day += timedelta(days=1)
+
+
+class Aggregate:
+    """
+    Per-user day and week totals built in a single sweep over attendance rows.
+
+    Spans are split at midnight and added into day buckets (and the week
+    bucket containing that day). Running totals are cumulative sums over the
+    week buckets, so a "total so far" lookup is a binary search.
+    """
+
+    days: Dict[Hashable, Dict[date, timedelta]]
+    weeks: Dict[Hashable, Dict[date, timedelta]]
+
+    def __init__(self):
+        self.days = defaultdict(lambda: defaultdict(timedelta))
+        self.weeks = defaultdict(lambda: defaultdict(timedelta))
+        self._active_weeks = set()
+        self._cumulative = {}
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[Tuple[Hashable, datetime, datetime]]) -> "Aggregate":
+        agg = cls()
+        for key, start, end in rows:
+            agg.add(key, start, end)
+        return agg
+
+    @classmethod
+    def from_days(cls, rows: Iterable[Tuple[Hashable, date, timedelta]]) -> "Aggregate":
+        agg = cls()
+        for key, day, duration in rows:
+            agg.add_day(key, day, duration)
+        return agg
+
+    def add(self, key: Hashable, start: datetime, end: datetime):
+        for day, duration in split_days(start, end):
+            self.add_day(key, day, duration)
+
+    def add_day(self, key: Hashable, day: date, duration: timedelta):
+        if not duration:
+            return
+        self._cumulative.pop(key, None)
+        self._active_weeks.add(week_start(day))
+        self.days[key][day] += duration
+        self.weeks[key][week_start(day)] += duration
+
+    def keys(self) -> List[Hashable]:
+        return list(self.days.keys())
+
+    def active_weeks(self) -> List[date]:
+        """
+        Weeks with any time recorded in them, newest first
+        """
+        return sorted(self._active_weeks, reverse=True)
+
+    def day_total(self, key: Hashable, day: date) -> timedelta:
+        return self.days[key].get(day, timedelta()) if key in self.days else timedelta()
+
+    def week_total(self, key: Hashable, week: date) -> timedelta:
+        return self.weeks[key].get(week, timedelta()) if key in self.weeks else timedelta()
+
+    def running_total(self, key: Hashable, week: date) -> timedelta:
+        """
+        Total of every week bucket up to and including `week`
+        """
+        if key not in self.weeks:
+            return timedelta()
+        if key not in self._cumulative:
+            weeks = sorted(self.weeks[key])
+            totals = list(accumulate((self.weeks[key][w] for w in weeks), initial=timedelta()))
+            self._cumulative[key] = (weeks, totals)
+
+        weeks, totals = self._cumulative[key]
+        return totals[bisect_right(weeks, week)]
@@ -1,5 +1,9 @@
+import asyncio
 import binascii
+from concurrent.futures import ThreadPoolExecutor
 import hashlib
+import secrets
+from time import monotonic, perf_counter
 from typing import Optional, Tuple
 from uuid import uuid4
 from sqlmodel import select, or_
@@ -9,34 +13,121 @@ from starlette.authentication import (
     SimpleUser,
 )
 
+from cache import TTLCache
+import metrics
 from db import *
 
+# sessionid -> (scopes, user, auth version); lets most requests authenticate
+# without SQLite
+session_cache = TTLCache(maxsize=1024, ttl=300)
+
+# keyed digest of user/pass headers -> (scopes, user, auth version), so clients
+# sending header auth on every call only pay for PBKDF2 once a minute
+credential_cache = TTLCache(maxsize=256, ttl=60)
+
+# the database bumps this scope on every logout and password or scope change
+# (see migrations.py), which is how other workers' cached entries go stale.
+# It's read at most once a second, so that's how long they can lag behind.
+AUTH = "auth"
+AUTH_VERSION_MAX_AGE = 1.0
+_auth_version: Tuple[float, Optional[int]] = (0.0, None)
+_credential_key = secrets.token_bytes(32)
+
+# PBKDF2 would stall the event loop, and is CPU bound, so only run a couple at once
+hash_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="pbkdf2")
+
+
+def invalidate_user(user: int):
+    """
+    Drop cached sessions and credentials for a user, call after deleting them
+    or changing their scopes
+    """
+    session_cache.discard_where(lambda entry: entry[1] == user)
+    credential_cache.discard_where(lambda entry: entry[1] == user)
+
+
+def auth_version() -> int:
+    global _auth_version
+    read_at, version = _auth_version
+    now = monotonic()
+    if version is None or now - read_at > AUTH_VERSION_MAX_AGE:
+        with Session(engine) as db:
+            row = db.get(DataVersion, AUTH)
+        version = row.version if row is not None else 0
+        _auth_version = (now, version)
+    return version
+
+
+def _cached(cache: TTLCache, key) -> Optional[Tuple[list, int]]:
+    cached = cache.get(key)
+    if cached is None:
+        return None
+    scopes, user, version = cached
+    if version != auth_version():
+        cache.pop(key)
+        return None
+    return scopes, user
+
+
+def _credential_digest(user: str, password: str) -> bytes:
+    return hashlib.blake2b(
+        f"{user}\0{password}".encode(), key=_credential_key, digest_size=32
+    ).digest()
+
+
 class BasicAuthBackend(AuthenticationBackend):
-    def _simple_auth(self, db: SessionDep, auth):
+    async def _simple_auth(self, auth):
         user = auth["user"]
-        password_hash = hash_password(auth["pass"])
+        digest = _credential_digest(user, auth["pass"])
+        cached = _cached(credential_cache, digest)
+        if cached is not None:
+            scopes, user = cached
+            return AuthCredentials(scopes), SimpleUser(user)
+
+        # read before the user, so a change in between leaves the entry stale
+        version = auth_version()
+        password_hash = await asyncio.get_running_loop().run_in_executor(
+            hash_executor, hash_password, auth["pass"]
+        )
 
-        auth_user = db.exec(
-            select(AuthUser)
-            .where(AuthUser.user == user)
-            .where(AuthUser.password == password_hash)
-        ).first()
+        with Session(engine) as db:
+            auth_user = db.exec(
+                select(AuthUser)
+                .where(AuthUser.user == user)
+                .where(AuthUser.password == password_hash)
+            ).first()
 
         if auth_user is None:
             return
-        return AuthCredentials(auth_user.scopes.split(",")), SimpleUser(auth_user.user)
+        scopes = auth_user.scopes.split(",")
+        credential_cache.set(digest, (scopes, auth_user.user, version))
+        return AuthCredentials(scopes), SimpleUser(auth_user.user)
         
 
     async def authenticate(self, conn):
-        with Session(engine) as db:
-            auth = conn.session.get("auth")
-            if auth is None:
-                headers = conn.headers
-                if "user" in headers and "pass" in headers:
-                    return self._simple_auth(db, headers)
-                print("no auth in session, skipping")
-                return
+        start = perf_counter()
+        try:
+            return await self._authenticate(conn)
+        finally:
+            metrics.auth_seconds.observe(perf_counter() - start)
+
+    async def _authenticate(self, conn):
+        auth = conn.session.get("auth")
+        if auth is None:
+            headers = conn.headers
+            if "user" in headers and "pass" in headers:
+                return await self._simple_auth(headers)
+            print("no auth in session, skipping")
+            return
 
+        if "sessionid" in auth:
+            cached = _cached(session_cache, auth["sessionid"])
+            if cached is not None:
+                scopes, user = cached
+                return AuthCredentials(scopes), SimpleUser(user)
+
+        version = auth_version()
+        with Session(engine) as db:
             if "sessionid" not in auth:
                 print("no sessionid in session, skipping")
                 conn.session.clear()
@@ -53,7 +144,9 @@ class BasicAuthBackend(AuthenticationBackend):
                 conn.session.clear()
                 return
 
-            return AuthCredentials(auth_user.scopes.split(",")), SimpleUser(auth_user.user)
+            scopes = auth_user.scopes.split(",")
+            session_cache.set(auth["sessionid"], (scopes, auth_user.user, version))
+            return AuthCredentials(scopes), SimpleUser(auth_user.user)
 
 
 def hash_password(password: str) -> str:
@@ -83,6 +176,7 @@ def try_login(
 
 
 def try_logout(sessionid: str, session: SessionDep) -> bool:
+    session_cache.pop(sessionid)
     auth_session = session.exec(
         select(AuthSession).where(AuthSession.sessionid == sessionid)
     ).first()
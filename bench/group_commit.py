@@ -0,0 +1,89 @@
+"""
+Punch throughput with and without the group-commit buffer.
+
+    uv run python bench/group_commit.py [--threads 16] [--punches 50]
+
+Runs against a throwaway database in a temp directory.
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+# never let the environment or a .env point the benchmark at a real database
+os.environ["DATABASE_PATH"] = os.path.join(tempfile.mkdtemp(), "database.db")
+
+from sqlmodel import Session, delete  # noqa: E402
+
+import clock  # noqa: E402
+from db import Attendance, DailyTotal, User, create_db_and_tables, engine  # noqa: E402
+from group_commit import GroupCommitter  # noqa: E402
+
+
+def run(label, punch, threads, punches, users):
+    with Session(engine) as session:
+        session.exec(delete(Attendance))
+        session.exec(delete(DailyTotal))
+        session.commit()
+
+    def worker(n):
+        latencies = []
+        for i in range(punches):
+            start = time.perf_counter()
+            punch(users[(n * punches + i) % len(users)])
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        latencies = [l for ls in pool.map(worker, range(threads)) for l in ls]
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    print(
+        f"{label:>14}: {len(latencies) / elapsed:8.1f} punches/s"
+        f"  p50 {statistics.median(latencies) * 1000:6.2f}ms"
+        f"  p99 {latencies[int(len(latencies) * 0.99)] * 1000:6.2f}ms"
+    )
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--punches", type=int, default=50)
+    parser.add_argument("--batch", type=int, default=64)
+    parser.add_argument("--window-ms", type=float, default=5)
+    args = parser.parse_args()
+
+    create_db_and_tables()
+    users = list(range(1, 201))
+    with Session(engine) as session:
+        for u in users:
+            session.add(User(user=u, name=f"user {u}"))
+        session.commit()
+
+    def direct(userid):
+        with Session(engine) as session:
+            clock.punch(session, userid)
+
+    elapsed = run("direct", direct, args.threads, args.punches, users)
+    print(f"{args.threads * args.punches} punches in {args.threads * args.punches} commits "
+          f"({args.threads * args.punches / elapsed:.1f} commits/s)")
+
+    committer = GroupCommitter(args.batch, args.window_ms / 1000)
+    committer.start()
+    elapsed = run("group commit", committer.punch, args.threads, args.punches, users)
+    committer.stop()
+    stats = committer.stats()
+    print(f"{stats['punches']} punches in {stats['batches']} commits "
+          f"({stats['batches'] / elapsed:.1f} commits/s, "
+          f"{stats['punches'] / max(stats['batches'], 1):.1f} punches per commit)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,354 @@
+"""
+Latency and throughput of the kiosk and report hot paths.
+
+    uv run python bench/hot_paths.py [--users 300] [--years 3] [--output results.json]
+    uv run python bench/hot_paths.py --compare before.json
+
+Seeds a throwaway database in a temp directory with a few years of
+attendance, drives the app in-process through httpx's ASGI transport (so
+middleware, auth and the threadpool are all included, the network isn't),
+then times Timeline on its own. Results are written as JSON, by default to
+bench-<commit>.json in the current directory; pass an earlier file to
+--compare to see the change.
+"""
+import argparse
+import asyncio
+from datetime import date, datetime, timedelta
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+CWD = os.getcwd()
+sys.path.insert(0, ROOT)
+# templates are found relative to the repo, like under `fastapi run`
+os.chdir(ROOT)
+# and never let a .env point the benchmark at a real database
+os.environ["DATABASE_PATH"] = os.path.join(tempfile.mkdtemp(), "database.db")
+os.environ.setdefault("SECRET", "bench")
+os.environ.setdefault("HA_URL", "http://127.0.0.1:9")
+os.environ.setdefault("HA_TOKEN", "bench")
+
+import httpx  # noqa: E402
+from sqlalchemy import insert  # noqa: E402
+from sqlmodel import Session  # noqa: E402
+from starlette.requests import Request  # noqa: E402
+
+from auth import BasicAuthBackend, credential_cache, hash_password, session_cache  # noqa: E402
+import clock  # noqa: E402
+from db import Attendance, AuthSession, AuthUser, User, create_db_and_tables, engine  # noqa: E402
+import main as app_main  # noqa: E402
+from reports import report_cache  # noqa: E402
+import rollup  # noqa: E402
+from timeline import DateSpan, Timeline  # noqa: E402
+
+ADMIN = 9000
+PASSWORD = "bench"
+SESSIONID = "bench-session"
+
+
+def summarize(latencies, elapsed):
+    latencies = sorted(latencies)
+
+    def pct(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+    return {
+        "requests": len(latencies),
+        "seconds": round(elapsed, 4),
+        "throughput": round(len(latencies) / elapsed, 2),
+        "p50_ms": round(pct(0.50), 4),
+        "p95_ms": round(pct(0.95), 4),
+        "p99_ms": round(pct(0.99), 4),
+        "max_ms": round(latencies[-1] * 1000, 4),
+    }
+
+
+def print_result(name, result):
+    print(
+        f"{name:>48}: {result['throughput']:10.1f}/s"
+        f"  p50 {result['p50_ms']:9.3f}ms"
+        f"  p95 {result['p95_ms']:9.3f}ms"
+        f"  p99 {result['p99_ms']:9.3f}ms"
+    )
+
+
+def seed(users, years, rng):
+    """
+    Evening sessions on weekdays, longer ones on weekends, each user turning
+    up with their own regularity. Everything is closed, as after the
+    midnight auto clock-out.
+    """
+    today = date.today()
+    first = date(today.year - years + 1, 1, 1)
+    with Session(engine) as session:
+        session.add(AuthUser(user=ADMIN, password=hash_password(PASSWORD), scopes="authenticated,admin"))
+        session.add(User(user=ADMIN, name="bench admin"))
+        session.add(AuthSession(sessionid=SESSIONID, user=ADMIN))
+        for u in range(1, users + 1):
+            session.add(User(user=u, name=f"User {u}", active=rng.random() < 0.9))
+        session.commit()
+
+        regularity = {u: rng.uniform(0.1, 0.7) for u in range(1, users + 1)}
+        rows = []
+        day = first
+        while day < today:
+            weekend = day.weekday() >= 5
+            for u, p in regularity.items():
+                if rng.random() >= (p / 2 if weekend else p):
+                    continue
+                if weekend:
+                    start = datetime.combine(day, datetime.min.time()) + timedelta(
+                        hours=9, minutes=rng.randrange(120)
+                    )
+                    length = timedelta(minutes=rng.randrange(180, 420))
+                else:
+                    start = datetime.combine(day, datetime.min.time()) + timedelta(
+                        hours=17, minutes=30 + rng.randrange(90)
+                    )
+                    length = timedelta(minutes=rng.randrange(90, 210))
+                rows.append({"user": u, "startedAt": start, "endedAt": start + length})
+            day += timedelta(days=1)
+
+        session.exec(insert(Attendance), params=rows)
+        rollup.rebuild(session)
+        session.commit()
+    return len(rows)
+
+
+async def measure(client, requests, concurrency, method, url, before=None):
+    """
+    Send `requests` requests, `concurrency` at a time. `before` runs ahead of
+    each one and isn't timed, which is how caches get cleared between
+    requests (only meaningful with concurrency 1).
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(i):
+        async with semaphore:
+            if before is not None:
+                before()
+            target = url(i) if callable(url) else url
+            start = time.perf_counter()
+            r = await client.request(method, target)
+            latencies.append(time.perf_counter() - start)
+            if r.status_code >= 400:
+                raise RuntimeError(f"{method} {target}: {r.status_code}")
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    return summarize(latencies, time.perf_counter() - start)
+
+
+async def measure_authenticate(requests, headers=(), session=None, before=None):
+    backend = BasicAuthBackend()
+    scope = {
+        "type": "http",
+        "headers": [(k.encode(), v.encode()) for k, v in headers],
+        "session": session or {},
+    }
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(requests):
+        if before is not None:
+            before()
+        t = time.perf_counter()
+        result = await backend.authenticate(Request(scope))
+        latencies.append(time.perf_counter() - t)
+        if result is None:
+            raise RuntimeError("authentication failed")
+    return summarize(latencies, time.perf_counter() - start)
+
+
+async def app_benchmarks(args, users):
+    results = {}
+
+    def record(name, result):
+        results[name] = result
+        print_result(name, result)
+
+    # refuse every cookie so flashed messages don't pile up in the session;
+    # the kiosk's session cookie is sent by hand instead
+    jar = CookieJar(DefaultCookiePolicy(allowed_domains=[]))
+    transport = httpx.ASGITransport(app=app_main.app)
+    async with app_main.lifespan(app_main.app), httpx.AsyncClient(
+        transport=transport, base_url="http://bench", cookies=jar
+    ) as client:
+        r = await client.post("/login", data={"userid": str(ADMIN), "password": PASSWORD})
+        client.headers["cookie"] = f"session={r.cookies['session']}"
+
+        record("GET /api/whois/{userid}", await measure(
+            client, args.requests, args.concurrency, "GET",
+            lambda i: f"/api/whois/{users[i % len(users)]}",
+        ))
+
+        record("BasicAuthBackend.authenticate session", await measure_authenticate(
+            args.requests, session={"auth": {"sessionid": SESSIONID}},
+        ))
+        record("BasicAuthBackend.authenticate session uncached", await measure_authenticate(
+            args.requests, session={"auth": {"sessionid": SESSIONID}}, before=session_cache.clear,
+        ))
+        record("BasicAuthBackend.authenticate headers", await measure_authenticate(
+            args.requests, headers=[("user", str(ADMIN)), ("pass", PASSWORD)],
+        ))
+        record("BasicAuthBackend.authenticate headers uncached", await measure_authenticate(
+            max(args.report_requests, 2), headers=[("user", str(ADMIN)), ("pass", PASSWORD)],
+            before=credential_cache.clear,
+        ))
+
+        year = date.today().year
+        for url in (f"/admin/time?year={year}", f"/admin/time/weeks/csv?year={year}"):
+            record(f"GET {url.partition('?')[0]}", await measure(
+                client, args.report_requests, 1, "GET", url, before=report_cache.clear,
+            ))
+            record(f"GET {url.partition('?')[0]} cached", await measure(
+                client, args.requests, args.concurrency, "GET", url,
+            ))
+        record("GET /admin/rawdata", await measure(
+            client, args.report_requests, 1, "GET", "/admin/rawdata",
+        ))
+
+        # a burst of swipes from distinct users, then the same users again
+        # to clock them back out
+        burst = min(args.requests, len(users))
+        for direction in ("in", "out"):
+            record(f"POST /users/submit {direction}", await measure_swipes(
+                client, users[:burst], args.concurrency,
+            ))
+
+    with Session(engine) as session:
+        clock.close_all_open(session, datetime.now())
+        session.commit()
+    return results
+
+
+async def measure_swipes(client, users, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def swipe(userid):
+        async with semaphore:
+            start = time.perf_counter()
+            r = await client.post("/users/submit", data={"userid": str(userid)})
+            latencies.append(time.perf_counter() - start)
+            if r.status_code != 303:
+                raise RuntimeError(f"swipe {userid}: {r.status_code}")
+
+    start = time.perf_counter()
+    await asyncio.gather(*(swipe(u) for u in users))
+    return summarize(latencies, time.perf_counter() - start)
+
+
+def timeline_benchmarks(sizes, queries, rng):
+    results = {}
+
+    def record(name, result):
+        results[name] = result
+        print_result(name, result)
+
+    for size in sizes:
+        spans = []
+        at = datetime(1990, 1, 1)
+        for _ in range(size):
+            at += timedelta(minutes=rng.randrange(30, 180))
+            spans.append(DateSpan(at, at + timedelta(minutes=rng.randrange(10, 120))))
+        rng.shuffle(spans)
+        first, last = min(s.start for s in spans), max(s.end for s in spans)
+
+        start = time.perf_counter()
+        timeline = Timeline.from_spans(spans)
+        timeline.dates
+        record(f"Timeline build {size}", summarize([time.perf_counter() - start], time.perf_counter() - start))
+
+        days = [first + (last - first) * rng.random() for _ in range(queries)]
+        for name in ("total_day_cc", "total_week_cc", "slice_day_cc", "slice_week_cc"):
+            query = getattr(timeline, name)
+            latencies = []
+            begin = time.perf_counter()
+            for day in days:
+                t = time.perf_counter()
+                query(day)
+                latencies.append(time.perf_counter() - t)
+            record(f"Timeline.{name} {size}", summarize(latencies, time.perf_counter() - begin))
+        del spans, timeline
+    return results
+
+
+def current_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(before, after):
+    print(f"\n{'':>48}  {before['commit']:>10} -> {after['commit']:<10}")
+    for name, new in after["results"].items():
+        old = before["results"].get(name)
+        if old is None:
+            continue
+        change = (new["p50_ms"] - old["p50_ms"]) / old["p50_ms"] * 100 if old["p50_ms"] else 0
+        print(
+            f"{name:>48}: p50 {old['p50_ms']:9.3f} -> {new['p50_ms']:9.3f}ms ({change:+6.1f}%)"
+            f"  p99 {old['p99_ms']:9.3f} -> {new['p99_ms']:9.3f}ms"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=300)
+    parser.add_argument("--years", type=int, default=3)
+    parser.add_argument("--requests", type=int, default=200, help="per fast endpoint")
+    parser.add_argument("--report-requests", type=int, default=10, help="per uncached report")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--spans", default="10000,100000,1000000")
+    parser.add_argument("--queries", type=int, default=1000, help="per Timeline method")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output")
+    parser.add_argument("--compare", help="earlier results to compare against")
+    args = parser.parse_args()
+
+    commit = current_commit()
+    output = os.path.join(CWD, args.output or f"bench-{commit}.json")
+    rng = random.Random(args.seed)
+
+    create_db_and_tables()
+    start = time.perf_counter()
+    rows = seed(args.users, args.years, rng)
+    print(f"seeded {args.users} users, {rows} sessions in {time.perf_counter() - start:.1f}s")
+
+    users = list(range(1, args.users + 1))
+    rng.shuffle(users)
+    results = asyncio.run(app_benchmarks(args, users))
+    sizes = [int(s) for s in args.spans.split(",") if s]
+    results |= timeline_benchmarks(sizes, args.queries, rng)
+
+    report = {
+        "commit": commit,
+        "at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "args": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        "env": {k: v for k, v in os.environ.items() if k.startswith(("GROUP_COMMIT", "SQLITE_"))},
+        "attendance": rows,
+        "results": results,
+    }
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"wrote {output}")
+
+    if args.compare:
+        with open(os.path.join(CWD, args.compare)) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Array-backed span storage for season-wide analytics. Spans are kept as
+int64 epoch-microsecond columns and bucketed for every user in one
+vectorized pass. Needs numpy (`uv sync --extra analytics`).
+"""
+
+from datetime import date, datetime, timedelta
+from typing import Hashable, Iterable, List, Tuple
+
+import numpy as np
+
+
+def to_epoch_us(dts) -> np.ndarray:
+    return np.asarray(dts, dtype="datetime64[us]").astype(np.int64)
+
+
+def day_edges(first: date, last: date) -> np.ndarray:
+    """
+    Midnights from `first` through the day after `last`
+    """
+    start = np.datetime64(first, "D")
+    stop = np.datetime64(last, "D") + np.timedelta64(2, "D")
+    return np.arange(start, stop, dtype="datetime64[D]").astype("datetime64[us]").astype(np.int64)
+
+
+def week_edges(first: date, last: date) -> np.ndarray:
+    """
+    Monday midnights covering every week from `first` through `last`
+    """
+    first = first - timedelta(days=first.weekday())
+    last = last - timedelta(days=last.weekday())
+    start = np.datetime64(first, "D")
+    stop = np.datetime64(last, "D") + np.timedelta64(8, "D")
+    return np.arange(start, stop, 7, dtype="datetime64[D]").astype("datetime64[us]").astype(np.int64)
+
+
+class SpanArray:
+    keys: List[Hashable]
+    users: np.ndarray
+    starts: np.ndarray
+    ends: np.ndarray
+
+    def __init__(self, keys: List[Hashable], users: np.ndarray, starts: np.ndarray, ends: np.ndarray):
+        self.keys = keys
+        self.users = users
+        self.starts = starts
+        self.ends = ends
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[Tuple[Hashable, datetime, datetime]]) -> "SpanArray":
+        index = {}
+        users, starts, ends = [], [], []
+        for key, start, end in rows:
+            users.append(index.setdefault(key, len(index)))
+            starts.append(start)
+            ends.append(end)
+        return cls(
+            list(index),
+            np.asarray(users, dtype=np.int64),
+            to_epoch_us(starts),
+            to_epoch_us(ends),
+        )
+
+    def __len__(self) -> int:
+        return len(self.users)
+
+    def bucket(self, edges: np.ndarray) -> np.ndarray:
+        """
+        Seconds each user spent in each [edges[i], edges[i+1]) bucket, as a
+        (len(keys), len(edges) - 1) array whose rows follow `self.keys`.
+        """
+        edges = np.asarray(edges, dtype=np.int64)
+        n_buckets = len(edges) - 1
+        out_size = len(self.keys) * n_buckets
+        if n_buckets < 1 or len(self) == 0:
+            return np.zeros((len(self.keys), max(n_buckets, 0)))
+
+        starts = np.clip(self.starts, edges[0], edges[-1])
+        ends = np.clip(self.ends, edges[0], edges[-1])
+        keep = ends > starts
+        starts, ends, users = starts[keep], ends[keep], self.users[keep]
+
+        # every span covers buckets first..last; repeat it once per bucket
+        first = np.searchsorted(edges, starts, side="right") - 1
+        last = np.searchsorted(edges, ends, side="left") - 1
+        counts = last - first + 1
+        span = np.repeat(np.arange(len(starts)), counts)
+        offset = np.arange(len(span)) - np.repeat(np.cumsum(counts) - counts, counts)
+        bucket = first[span] + offset
+
+        piece_start = np.maximum(starts[span], edges[bucket])
+        piece_end = np.minimum(ends[span], edges[bucket + 1])
+
+        totals = np.bincount(
+            users[span] * n_buckets + bucket,
+            weights=(piece_end - piece_start).astype(np.float64),
+            minlength=out_size,
+        )
+        return totals.reshape(len(self.keys), n_buckets) / 1_000_000
+
+    def per_day(self, first: date, last: date) -> Tuple[List[date], np.ndarray]:
+        edges = day_edges(first, last)
+        days = [first + timedelta(days=i) for i in range(len(edges) - 1)]
+        return days, self.bucket(edges)
+
+    def per_week(self, first: date, last: date) -> Tuple[List[date], np.ndarray]:
+        edges = week_edges(first, last)
+        monday = first - timedelta(days=first.weekday())
+        weeks = [monday + timedelta(weeks=i) for i in range(len(edges) - 1)]
+        return weeks, self.bucket(edges)
+
@@ -3,6 +3,7 @@ from datetime import datetime
 from sqlmodel import select
 import db
 from db import Attendance, User
+import rollup
 
 # START = datetime(year=2026, month=1, day=10, hour=9, minute=30)
 # END = datetime(year=2026, month=1, day=10, hour=5 + 12)
@@ -17,5 +18,7 @@ for user in active_users:
     print(entry)
     session.add(entry)
 
+# keep the daily totals the reports read in step
+rollup.record_many(session, [(user.user, START, END) for user in active_users])
 # session.commit()
 print(f"Added {len(active_users)} entries")
@@ -0,0 +1,177 @@
+from datetime import datetime
+from typing import List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import Row, case, func, insert, update
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session, select
+
+from db import Attendance, PunchReceipt
+import presence
+import rollup
+from roster import roster
+
+
+class Punch(NamedTuple):
+    user: int
+    name: str
+    clocked_in: bool
+    attendance: int
+    at: datetime
+
+
+class OutOfOrder(Exception):
+    pass
+
+
+def toggle(
+    session: Session, userid: int, at: datetime, ordered: bool = False
+) -> Optional[Punch]:
+    """
+    Clock a user out if they have an open session, otherwise clock them in.
+
+    The UPDATE is the first statement so the transaction takes the write
+    lock before it reads anything, and the partial unique index on open
+    sessions stops two racing clock-ins from both landing. Doesn't commit.
+    Returns None for an unknown user, without writing anything.
+
+    With `ordered`, a punch from before the user's open session started
+    raises OutOfOrder instead of closing it with a negative duration.
+    """
+    # looked up outside the session, a cache miss mustn't start the
+    # transaction with a read
+    user = roster.get(userid)
+    if user is None:
+        return None
+    name = user.name
+
+    close = (
+        update(Attendance)
+        .where(Attendance.user == userid)
+        .where(Attendance.endedAt.is_(None))
+        .values(endedAt=at)
+        .returning(Attendance.id, Attendance.startedAt)
+    )
+    if ordered:
+        close = close.where(Attendance.startedAt <= at)
+    closed = session.exec(close).first()
+
+    if closed is not None:
+        rollup.record(session, userid, closed.startedAt, at)
+        return Punch(userid, name, False, closed.id, at)
+
+    if ordered and session.exec(
+        select(Attendance.id)
+        .where(Attendance.user == userid)
+        .where(Attendance.endedAt.is_(None))
+    ).first() is not None:
+        raise OutOfOrder(f"{userid} has a session open since after {at}")
+
+    opened = session.exec(
+        insert(Attendance).values(user=userid, startedAt=at).returning(Attendance.id)
+    ).first()
+    return Punch(userid, name, True, opened.id, at)
+
+
+def publish(result: Punch):
+    if result.clocked_in:
+        presence.clocked_in(result.user, result.name, result.at)
+    else:
+        presence.clocked_out(result.user)
+
+
+def punch(session: Session, userid: int, at: Optional[datetime] = None) -> Optional[Punch]:
+    """
+    Toggle and commit in one transaction. A clock-in that loses a race to
+    another clock-in for the same user is retried, which clocks them back out,
+    same as if the two swipes had been handled one after the other.
+    """
+    for attempt in range(2):
+        try:
+            result = toggle(session, userid, at or datetime.now())
+            if result is None:
+                session.rollback()
+                return None
+            session.commit()
+            publish(result)
+            return result
+        except IntegrityError:
+            session.rollback()
+            if attempt:
+                raise
+
+
+# the midnight job ends a session at 17:00 on the day it started if that was a
+# weekend, 20:00 on a weekday. strftime('%w') is 0 for Sunday, 6 for Saturday.
+AUTO_CLOCKOUT_END = func.strftime(
+    case(
+        (func.strftime("%w", Attendance.startedAt).in_(["0", "6"]), "%Y-%m-%d 17:00:00.000000"),
+        else_="%Y-%m-%d 20:00:00.000000",
+    ),
+    Attendance.startedAt,
+)
+
+
+def close_all_open(session: Session, ended_at, info: Optional[str] = None) -> List[Row]:
+    """
+    Close every open session with a single UPDATE and roll their time up.
+    `ended_at` is a datetime or a SQL expression over the row, like
+    AUTO_CLOCKOUT_END. Returns (id, user, startedAt, endedAt) for each
+    closed session. Doesn't commit.
+    """
+    values = {"endedAt": ended_at}
+    if info is not None:
+        values["info"] = info
+    closed = session.exec(
+        update(Attendance)
+        .where(Attendance.endedAt.is_(None))
+        .values(values)
+        .returning(Attendance.id, Attendance.user, Attendance.startedAt, Attendance.endedAt)
+    ).all()
+    rollup.record_many(session, [(r.user, r.startedAt, r.endedAt) for r in closed])
+    return closed
+
+
+class BatchResult(NamedTuple):
+    key: str
+    status: str
+    punch: Optional[Punch] = None
+    error: Optional[str] = None
+
+
+def apply_batch(session: Session, punches: List[Tuple[str, int, datetime]]) -> List[BatchResult]:
+    """
+    Apply queued (key, userid, at) punches in timestamp order with a single
+    commit, returning a result per punch in the order given. Keys that were
+    already applied, earlier in the batch or in a previous one, come back as
+    duplicates, so a kiosk can safely resend until it sees a response.
+    """
+    seen = set(
+        session.exec(
+            select(PunchReceipt.key).where(PunchReceipt.key.in_([p[0] for p in punches]))
+        ).all()
+    )
+
+    results: List[Optional[BatchResult]] = [None] * len(punches)
+    for i in sorted(range(len(punches)), key=lambda i: (punches[i][2], i)):
+        key, userid, at = punches[i]
+        if key in seen:
+            results[i] = BatchResult(key, "duplicate")
+            continue
+        seen.add(key)
+        try:
+            result = toggle(session, userid, at, ordered=True)
+        except OutOfOrder as e:
+            results[i] = BatchResult(key, "rejected", error=str(e))
+            continue
+        if result is None:
+            results[i] = BatchResult(key, "rejected", error=f"Unknown UserID `{userid}`")
+            continue
+        session.add(PunchReceipt(key=key, attendance=result.attendance))
+        results[i] = BatchResult(key, "applied", punch=result)
+
+    session.commit()
+    for result in sorted(
+        (r for r in results if r.punch is not None), key=lambda r: r.punch.at
+    ):
+        publish(result.punch)
+    return results
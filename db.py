@@ -1,14 +1,20 @@
 
-from datetime import datetime
-from typing import Annotated
+from datetime import date, datetime
+import os
+from typing import Annotated, List
+from dotenv import load_dotenv
 from fastapi import Depends
-from sqlalchemy import create_engine
+from sqlalchemy import Engine, Index, create_engine, event, text
 from sqlmodel import Field, SQLModel, Session
 
+import metrics
+from migrations import migrate
+from slowlog import SlowQueryLog
+
 
 class User(SQLModel, table=True):
     user: int = Field(default=None, primary_key=True)
-    name: str
+    name: str = Field(index=True)
     active: bool = Field(default=True)
 
     def displayName(self):
@@ -27,6 +33,17 @@ class AuthSession(SQLModel, table=True):
 
 
 class Attendance(SQLModel, table=True):
+    __table_args__ = (
+        # at most one open session per user, see clock.toggle
+        Index(
+            "ix_attendance_open_user",
+            "user",
+            unique=True,
+            sqlite_where=text('"endedAt" IS NULL'),
+        ),
+        Index("ix_attendance_startedAt_user", "startedAt", "user"),
+    )
+
     id: int | None = Field(default=None, primary_key=True)
     user: int = Field(index=True)
     startedAt: datetime = Field(default_factory=datetime.now)
@@ -34,15 +51,133 @@ class Attendance(SQLModel, table=True):
     info: str | None =Field(default=None)
 
 
-sqlite_file_name = "database.db"
+class PunchReceipt(SQLModel, table=True):
+    """
+    Idempotency keys of punches applied through /api/punches/batch
+    """
+    key: str = Field(primary_key=True)
+    attendance: int
+    appliedAt: datetime = Field(default_factory=datetime.now)
+
+
+class DataVersion(SQLModel, table=True):
+    """
+    Counters bumped by triggers whenever attendance in a year ("year:2026")
+    or any user ("users") changes, see migrations.py
+    """
+    scope: str = Field(primary_key=True)
+    version: int = Field(default=0)
+
+
+class JobLease(SQLModel, table=True):
+    """
+    Cross-process lock, held by `owner` until `expiresAt` (see jobs.py)
+    """
+    name: str = Field(primary_key=True)
+    owner: str
+    expiresAt: datetime
+
+
+class JobRun(SQLModel, table=True):
+    id: int | None = Field(default=None, primary_key=True)
+    name: str = Field(index=True)
+    owner: str
+    startedAt: datetime = Field(default_factory=datetime.now)
+    seconds: float | None = Field(default=None)
+    rows: int | None = Field(default=None)
+    error: str | None = Field(default=None)
+
+
+class DailyTotal(SQLModel, table=True):
+    """
+    Rollup of closed attendance per user per calendar day, kept in step with
+    every attendance write (see rollup.py)
+    """
+    user: int = Field(primary_key=True)
+    day: date = Field(primary_key=True)
+    seconds: float = Field(default=0)
+
+
+load_dotenv()
+
+sqlite_file_name = os.getenv("DATABASE_PATH", "database.db")
 sqlite_url = f"sqlite:///{sqlite_file_name}"
 
-connect_args = {"check_same_thread": False}
-engine = create_engine(sqlite_url, connect_args=connect_args)
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+# negative means KiB rather than pages
+SQLITE_CACHE_SIZE = int(os.getenv("SQLITE_CACHE_SIZE", str(-64 * 1024)))
+SQLITE_READ_POOL_SIZE = int(os.getenv("SQLITE_READ_POOL_SIZE", "4"))
+
+# log statements slower than this many milliseconds, off when unset
+SLOW_QUERY_MS = os.getenv("SLOW_QUERY_MS")
+slow_queries = SlowQueryLog(float(SLOW_QUERY_MS) / 1000) if SLOW_QUERY_MS else None
+
+
+def make_engine(url: str, readonly: bool = False, pool_size: int = 5) -> Engine:
+    """
+    SQLite engine that sets up every new connection for a web server: WAL so
+    readers don't block the writer (and vice versa), a busy timeout instead of
+    failing straight away with "database is locked", and a bigger page cache.
+
+    A readonly engine's connections refuse writes (query_only), which keeps
+    long report queries off the write path.
+    """
+    engine = create_engine(
+        url,
+        connect_args={
+            "check_same_thread": False,
+            "timeout": SQLITE_BUSY_TIMEOUT_MS / 1000,
+        },
+        pool_size=pool_size,
+    )
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        if not readonly:
+            # persistent, stored in the database file
+            cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+        cursor.execute(f"PRAGMA cache_size={SQLITE_CACHE_SIZE}")
+        if readonly:
+            cursor.execute("PRAGMA query_only=ON")
+        cursor.close()
+
+    metrics.instrument(engine)
+    if slow_queries is not None:
+        slow_queries.install(engine)
+    return engine
+
+
+engine = make_engine(sqlite_url)
+read_engine = make_engine(sqlite_url, readonly=True, pool_size=SQLITE_READ_POOL_SIZE)
 
 
 def create_db_and_tables():
-    SQLModel.metadata.create_all(engine)
+    # one worker at a time, or they race each other's CREATE and ALTER
+    with engine.connect() as conn:
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+        SQLModel.metadata.create_all(conn)
+        migrate(conn)
+        conn.commit()
+
+
+def available_years(session: Session) -> List[int]:
+    """
+    Years with any attendance, newest first. Reads the indexed `year` column
+    added in migrations.py.
+    """
+    return [
+        y
+        for y in session.exec(
+            text("SELECT DISTINCT year FROM attendance ORDER BY year DESC")
+        ).scalars()
+        if y
+    ]
 
 
 def get_session():
@@ -50,3 +185,10 @@ def get_session():
         yield session
 
 SessionDep = Annotated[Session, Depends(get_session)]
+
+
+def get_read_session():
+    with Session(read_engine) as session:
+        yield session
+
+ReadSessionDep = Annotated[Session, Depends(get_read_session)]
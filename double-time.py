@@ -4,6 +4,7 @@ from datetime import datetime, timedelta
 from sqlmodel import select
 import db
 from db import Attendance, User
+import rollup
 from timeline import Timeline
 
 # BEGIN_AT = datetime(year=2025, month=1, day=25, hour=5 + 12)
@@ -19,6 +20,7 @@ attendance = session.exec(
 ).all()
 
 user_timelines = defaultdict(lambda: Timeline())
+added = []
 for atnd, user in attendance:
     user_timelines[user.user].add(
         atnd.startedAt, atnd.endedAt or datetime.now()
@@ -58,4 +60,7 @@ for u, tl in user_timelines.items():
 
     print(Attendance(user=u, startedAt = begin, endedAt=end,info="doubletime"))
     session.add(Attendance(user=u, startedAt = begin, endedAt=end,info="doubletime"))
+    added.append((u, begin, end))
+# keep the daily totals the reports read in step
+rollup.record_many(session, added)
 session.commit()
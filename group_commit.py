@@ -0,0 +1,155 @@
+from concurrent.futures import Future
+from datetime import datetime
+import queue
+from threading import Thread
+import time
+from typing import List, Optional, Tuple
+
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session
+
+import clock
+from clock import Punch
+from db import engine
+
+
+class GroupCommitter:
+    """
+    Write-behind buffer for punches.
+
+    Every punch costs a commit, and on SQLite a commit is an fsync under the
+    database write lock, so a burst of swipes queues up behind each other.
+    Here request threads hand their punch to a single writer thread, which
+    waits up to `window` seconds for more to arrive (at most `batch_size`),
+    applies them all in one transaction and commits once. Each caller still
+    blocks until the commit holding its punch is durable, or `timeout`
+    seconds. If the writer thread is gone, punches are applied directly.
+    """
+
+    def __init__(self, batch_size: int = 64, window: float = 0.005, timeout: float = 10):
+        self.batch_size = batch_size
+        self.window = window
+        self.timeout = timeout
+        self.batches = 0
+        self.punches = 0
+        self._queue: queue.Queue = queue.Queue()
+        self._thread: Optional[Thread] = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = Thread(target=self._run, name="group-commit", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def alive(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def submit(self, userid: int, at: Optional[datetime] = None) -> "Future[Optional[Punch]]":
+        future = Future()
+        self._queue.put((userid, at or datetime.now(), future))
+        return future
+
+    def punch(self, userid: int) -> Optional[Punch]:
+        at = datetime.now()
+        if not self.alive():
+            return self._punch_direct(userid, at)
+        future = self.submit(userid, at)
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            # a punch the writer never picked up can be cancelled and done
+            # here; one it's working on can't, or it would be applied twice
+            if self.alive() or not future.cancel():
+                raise
+            print(f"[group_commit] writer thread is gone, punching {userid} directly")
+            return self._punch_direct(userid, at)
+
+    def _punch_direct(self, userid: int, at: datetime) -> Optional[Punch]:
+        with Session(engine) as session:
+            return clock.punch(session, userid, at)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._commit_safely(batch)
+                    return
+                batch.append(item)
+            self._commit_safely(batch)
+
+    def _commit_safely(self, batch: List[Tuple[int, datetime, Future]]):
+        # whatever goes wrong, every caller gets an answer and the writer
+        # lives on to take the next batch
+        try:
+            self._commit(batch)
+        except Exception as e:
+            print(f"[group_commit] batch of {len(batch)} failed: {e!r}")
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+    def _commit(self, batch: List[Tuple[int, datetime, Future]]):
+        batch = [item for item in batch if item[2].set_running_or_notify_cancel()]
+        if not batch:
+            return
+        with Session(engine) as session:
+            try:
+                # an unknown user's punch comes back None without having
+                # written anything, so it can't leak into the shared commit
+                results = [clock.toggle(session, userid, at) for userid, at, _ in batch]
+                session.commit()
+            except IntegrityError:
+                # lost a race with a writer outside the buffer, fall back to
+                # one transaction per punch so the retry in clock.punch applies
+                session.rollback()
+                self._commit_each(session, batch)
+                return
+            except Exception as e:
+                session.rollback()
+                for _, _, future in batch:
+                    future.set_exception(e)
+                return
+
+        self.batches += 1
+        self.punches += len(batch)
+        for result, (_, _, future) in zip(results, batch):
+            if result is not None:
+                try:
+                    clock.publish(result)
+                except Exception as e:
+                    print(f"[group_commit] publishing punch for {result.user} failed: {e!r}")
+            future.set_result(result)
+
+    def _commit_each(self, session: Session, batch: List[Tuple[int, datetime, Future]]):
+        for userid, at, future in batch:
+            try:
+                future.set_result(clock.punch(session, userid, at))
+            except Exception as e:
+                session.rollback()
+                future.set_exception(e)
+        self.batches += len(batch)
+        self.punches += len(batch)
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "punches": self.punches,
+            "pending": self._queue.qsize(),
+        }
@@ -0,0 +1,143 @@
+import asyncio
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import httpx
+
+
+class HomeAssistantError(Exception):
+    pass
+
+
+class CircuitOpen(HomeAssistantError):
+    pass
+
+
+class HomeAssistant:
+    """
+    Async Home Assistant REST client shared by every request.
+
+    Connections are pooled and kept alive, every call has a hard timeout and
+    transport errors/5xx are retried with exponential backoff. After
+    `failure_threshold` failed calls in a row the circuit opens and calls fail
+    straight away for `reset_after` seconds, then a single trial call is let
+    through to test the water while the rest keep failing fast. Presses for
+    the same entity within `coalesce_window` seconds that ask for the same
+    service share a single call.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        token: str,
+        timeout: float = 3.0,
+        connect_timeout: float = 1.0,
+        retries: int = 2,
+        backoff: float = 0.2,
+        failure_threshold: int = 3,
+        reset_after: float = 30.0,
+        coalesce_window: float = 2.0,
+    ):
+        self.url = url
+        self.token = token
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+        self.coalesce_window = coalesce_window
+        self.calls = 0
+        self.coalesced = 0
+        self.failures = 0
+        self._opened_at: Optional[float] = None
+        self._probing = False
+        self._client: Optional[httpx.AsyncClient] = None
+        # entity -> (service, started at, call)
+        self._recent: Dict[str, Tuple[str, float, asyncio.Future]] = {}
+
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.url,
+                headers={"Authorization": f"Bearer {self.token}"},
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=4, max_keepalive_connections=2),
+            )
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def call_service(self, domain: str, service: str, data: Dict[str, Any]) -> httpx.Response:
+        entity = data.get("entity_id", "")
+        recent = self._recent.get(entity)
+        if recent is not None and recent[0] == service and self._shareable(*recent[1:]):
+            self.coalesced += 1
+            return await asyncio.shield(recent[2])
+
+        call = asyncio.ensure_future(self._call(domain, service, data))
+        self._recent[entity] = (service, time.monotonic(), call)
+        return await asyncio.shield(call)
+
+    def _shareable(self, started: float, call: asyncio.Future) -> bool:
+        if not call.done():
+            return True
+        # a failed call shouldn't swallow the retry press
+        if call.cancelled() or call.exception() is not None:
+            return False
+        return time.monotonic() - started < self.coalesce_window
+
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at < self.reset_after:
+            return "open"
+        return "half-open"
+
+    async def _call(self, domain: str, service: str, data: Dict[str, Any]) -> httpx.Response:
+        state = self.state()
+        if state == "open":
+            raise CircuitOpen("Home Assistant is unreachable, not retrying yet")
+        if state == "half-open":
+            if self._probing:
+                raise CircuitOpen("Home Assistant is unreachable, waiting on a trial call")
+            self._probing = True
+            try:
+                return await self._attempt(domain, service, data)
+            finally:
+                self._probing = False
+        return await self._attempt(domain, service, data)
+
+    async def _attempt(self, domain: str, service: str, data: Dict[str, Any]) -> httpx.Response:
+        self.calls += 1
+        error: Exception = HomeAssistantError("no attempts made")
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                response = await self.client().post(f"/api/services/{domain}/{service}", json=data)
+            except httpx.TransportError as e:
+                error = e
+                continue
+            if response.status_code >= 500:
+                error = HomeAssistantError(f"{response.status_code} {response.text[:200]}")
+                continue
+            # 4xx won't get better by retrying, but it means HA is up
+            self.failures = 0
+            self._opened_at = None
+            return response
+
+        self.failures += 1
+        if self.failures >= self.failure_threshold or self._opened_at is not None:
+            self._opened_at = time.monotonic()
+        raise HomeAssistantError(str(error) or type(error).__name__) from error
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "failures": self.failures,
+            "circuit": self.state(),
+        }
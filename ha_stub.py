@@ -0,0 +1,115 @@
+"""
+Stand-in for the Home Assistant REST API, for trying the fan buttons without
+a real HA.
+
+    uv run python ha_stub.py [--port 8123] [--delay 0] [--fail-rate 0]
+
+then point HA_URL at http://127.0.0.1:8123 (any HA_TOKEN works unless
+--token is given). --delay makes every call slow and --fail-rate answers
+that fraction of calls with a 500, to exercise timeouts, retries and the
+circuit breaker. tests/test_ha.py runs the client against it.
+"""
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import random
+import threading
+import time
+from typing import Optional
+
+
+class StubHomeAssistant(ThreadingHTTPServer):
+    def __init__(
+        self,
+        port: int = 8123,
+        token: Optional[str] = None,
+        delay: float = 0,
+        fail_rate: float = 0,
+    ):
+        super().__init__(("127.0.0.1", port), Handler)
+        self.token = token
+        self.delay = delay
+        self.fail_rate = fail_rate
+        # answer this many calls with a 500 before going by fail_rate
+        self.fail_next = 0
+        self.calls = []
+        self.states = {}
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self) -> "StubHomeAssistant":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class Handler(BaseHTTPRequestHandler):
+    server: StubHomeAssistant
+
+    def reply(self, status: int, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def authorized(self) -> bool:
+        if self.server.token is None:
+            return True
+        return self.headers.get("Authorization") == f"Bearer {self.server.token}"
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if not self.authorized():
+            return self.reply(401, {"message": "Unauthorized"})
+        parts = self.path.strip("/").split("/")
+        if len(parts) != 4 or parts[:2] != ["api", "services"]:
+            return self.reply(404, {"message": "Not found"})
+
+        time.sleep(self.server.delay)
+        self.server.calls.append((parts[2], parts[3], body))
+        if self.server.fail_next > 0:
+            self.server.fail_next -= 1
+            return self.reply(500, {"message": "stub failure"})
+        if random.random() < self.server.fail_rate:
+            return self.reply(500, {"message": "stub failure"})
+
+        entity = body.get("entity_id")
+        state = {"turn_on": "on", "turn_off": "off"}.get(parts[3])
+        if entity and state:
+            self.server.states[entity] = state
+        return self.reply(200, [{"entity_id": entity, "state": self.server.states.get(entity)}])
+
+    def do_GET(self):
+        if not self.authorized():
+            return self.reply(401, {"message": "Unauthorized"})
+        if self.path.startswith("/api/states/"):
+            entity = self.path.removeprefix("/api/states/")
+            if entity not in self.server.states:
+                return self.reply(404, {"message": "Entity not found."})
+            return self.reply(200, {"entity_id": entity, "state": self.server.states[entity]})
+        if self.path.rstrip("/") == "/api":
+            return self.reply(200, {"message": "API running."})
+        return self.reply(404, {"message": "Not found"})
+
+    def log_message(self, format, *args):
+        print("[ha-stub]", format % args)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8123)
+    parser.add_argument("--token")
+    parser.add_argument("--delay", type=float, default=0)
+    parser.add_argument("--fail-rate", type=float, default=0)
+    args = parser.parse_args()
+
+    server = StubHomeAssistant(args.port, args.token, args.delay, args.fail_rate)
+    print(f"[ha-stub] listening on http://127.0.0.1:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
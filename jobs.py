@@ -0,0 +1,104 @@
+from datetime import datetime, timedelta
+import functools
+import os
+import socket
+import time
+from typing import Callable, Optional
+from uuid import uuid4
+
+from sqlalchemy import delete, or_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlmodel import Session, select
+
+from db import JobLease, JobRun, engine
+import metrics
+
+# every worker process runs its own scheduler; only the one holding the
+# leader lease actually runs the jobs
+LEADER = "scheduler"
+LEASE_SECONDS = 90
+RENEW_SECONDS = 30
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+
+
+def acquire(session: Session, name: str, seconds: float = LEASE_SECONDS) -> bool:
+    """
+    Take or renew the lease `name`. Succeeds if nobody holds it, we already
+    do, or the holder let it expire (e.g. the process died). The check and
+    the write are one statement, so two workers can't both win.
+    """
+    now = datetime.now()
+    stmt = sqlite_insert(JobLease).values(
+        name=name, owner=WORKER_ID, expiresAt=now + timedelta(seconds=seconds)
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[JobLease.name],
+        set_={"owner": stmt.excluded.owner, "expiresAt": stmt.excluded.expiresAt},
+        where=or_(JobLease.owner == WORKER_ID, JobLease.expiresAt < now),
+    )
+    won = session.exec(stmt.returning(JobLease.name)).first() is not None
+    session.commit()
+    return won
+
+
+def release(session: Session, name: str):
+    session.exec(
+        delete(JobLease).where(JobLease.name == name).where(JobLease.owner == WORKER_ID)
+    )
+    session.commit()
+
+
+def leader() -> Optional[JobLease]:
+    with Session(engine) as session:
+        lease = session.get(JobLease, LEADER)
+    if lease is None or lease.expiresAt < datetime.now():
+        return None
+    return lease
+
+
+def heartbeat():
+    with Session(engine) as session:
+        acquire(session, LEADER)
+
+
+def resign():
+    with Session(engine) as session:
+        release(session, LEADER)
+
+
+def leader_only(name: str, job: Callable[[], Optional[int]]) -> Callable[[], None]:
+    """
+    Wrap a scheduled job so it only runs on the leader, and record each run
+    in JobRun. The job may return how many rows it touched.
+    """
+
+    @functools.wraps(job)
+    def run():
+        with Session(engine) as session:
+            if not acquire(session, LEADER):
+                return
+            record = JobRun(name=name, owner=WORKER_ID)
+            session.add(record)
+            session.commit()
+            session.refresh(record)
+
+        start = time.perf_counter()
+        try:
+            record.rows = job()
+        except Exception as e:
+            record.error = repr(e)
+            raise
+        finally:
+            record.seconds = time.perf_counter() - start
+            metrics.job_seconds.observe(record.seconds, job=name)
+            metrics.job_runs.inc(job=name, result="error" if record.error else "ok")
+            with Session(engine) as session:
+                session.add(record)
+                session.commit()
+
+    return run
+
+
+def recent_runs(session: Session, limit: int = 50):
+    return session.exec(select(JobRun).order_by(JobRun.id.desc()).limit(limit)).all()
@@ -1,28 +1,33 @@
-from collections import defaultdict
+import asyncio
 from contextlib import asynccontextmanager
 import io
 import csv
-import itertools
-from typing import Annotated, Dict, List, Optional
+import json
+from typing import Annotated, Dict, List, Iterator, Literal, NamedTuple, Optional, Tuple
 import typing
 import os
+import zlib
 from urllib.parse import urlencode, urlparse, parse_qs, urlunparse
 
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
-from fastapi import Body, FastAPI, Form, Request
+from apscheduler.triggers.interval import IntervalTrigger
+from fastapi import Body, FastAPI, Form, Query, Request
 from fastapi.exceptions import RequestValidationError
 from fastapi.responses import (
     HTMLResponse,
+    JSONResponse,
     PlainTextResponse,
     RedirectResponse,
+    Response,
     StreamingResponse,
 )
 from pydantic import BaseModel
-import requests
-from sqlalchemy import func, text
+from sqlalchemy import text, tuple_
+from sqlalchemy.exc import IntegrityError
 from sqlmodel import or_, select
 from fastapi.templating import Jinja2Templates
+from starlette.concurrency import run_in_threadpool
 from starlette.middleware.authentication import AuthenticationMiddleware
 from starlette.authentication import (
     requires,
@@ -37,7 +42,18 @@ from auth import *
 
 from datetime import datetime, date, time, timedelta
 
-from timeline import Timeline
+from aggregate import Aggregate
+import clock
+from group_commit import GroupCommitter
+from ha import HomeAssistant, HomeAssistantError
+import jobs
+import metrics
+from metrics import MetricsMiddleware
+from profiler import ProfileMiddleware
+import presence
+import rollup
+from reports import USERS, data_version, etag as report_etag, etag_matches, report_cache, year_scope
+from roster import roster
 
 load_dotenv()
 
@@ -50,21 +66,15 @@ def auto_clockout():
     Sets end time to 17:00 on weekends, 20:00 on weekdays.
     """
     with Session(engine) as session:
-        open_sessions = session.exec(
-            select(Attendance).where(Attendance.endedAt.is_(None))
-        ).all()
-        
-        for ses in open_sessions:
-            started_date = ses.startedAt.date()
-            is_weekend = started_date.weekday() >= 5  # Saturday=5, Sunday=6
-            clockout_hour = 17 if is_weekend else 20
-            ses.endedAt = datetime.combine(started_date, time(hour=clockout_hour, minute=0))
-            ses.info = "auto-clockout"
-            session.add(ses)
-        
+        open_sessions = clock.close_all_open(
+            session, clock.AUTO_CLOCKOUT_END, info="auto-clockout"
+        )
         session.commit()
+        for ses in open_sessions:
+            presence.clocked_out(ses.user)
         if len(open_sessions) > 0:
             print(f"[auto-clockout] Clocked out {len(open_sessions)} users")
+        return len(open_sessions)
 
 SECRET_KEY = os.getenv("SECRET")
 if SECRET_KEY is None:
@@ -75,6 +85,21 @@ if SECRET_KEY is None:
 HA_URL = os.getenv("HA_URL")
 if HA_URL is None:
     raise Exception("HA_URL env var must be set. use .env file")
+home_assistant = HomeAssistant(HA_URL, HA_TOKEN)
+
+# optional write-behind for punches, batches swipes into one commit
+committer = None
+if os.getenv("GROUP_COMMIT", "0") not in ("", "0"):
+    committer = GroupCommitter(
+        batch_size=int(os.getenv("GROUP_COMMIT_BATCH", "64")),
+        window=float(os.getenv("GROUP_COMMIT_WINDOW_MS", "5")) / 1000,
+    )
+
+
+def punch_user(session: Session, userid: int):
+    if committer is not None:
+        return committer.punch(userid)
+    return clock.punch(session, userid)
 
 
 def flash(request: Request, message: typing.Any, category: typing.Any):
@@ -90,24 +115,79 @@ def get_flashed_messages(request: Request):
 templates = Jinja2Templates(directory="templates")
 templates.env.globals["get_flashed_messages"] = get_flashed_messages
 
+STREAM_CHUNK_SIZE = 16 * 1024
+
+
+def stream_template(
+    request: Request, name: str, context: dict, headers: Optional[dict] = None
+) -> StreamingResponse:
+    """
+    Render a template while it's being sent, in chunks of about
+    STREAM_CHUNK_SIZE characters, so a big table never sits in memory whole.
+
+    The session cookie goes out with the response headers, before the body
+    is rendered, so flash messages are taken out of the session up front.
+    """
+    messages = get_flashed_messages(request)
+    context = {
+        "request": request,
+        "get_flashed_messages": lambda request: messages,
+        **context,
+    }
+
+    def chunks():
+        buffer = []
+        size = 0
+        for part in templates.get_template(name).generate(context):
+            buffer.append(part)
+            size += len(part)
+            if size >= STREAM_CHUNK_SIZE:
+                yield "".join(buffer)
+                buffer = []
+                size = 0
+        if buffer:
+            yield "".join(buffer)
+
+    return StreamingResponse(chunks(), media_type="text/html", headers=headers)
+
 middleware = [
+    Middleware(MetricsMiddleware),
     Middleware(SessionMiddleware, secret_key=SECRET_KEY),
     Middleware(AuthenticationMiddleware, backend=BasicAuthBackend()),
+    Middleware(ProfileMiddleware),
 ]
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    presence.hub.bind(asyncio.get_running_loop())
     create_db_and_tables()
+    with Session(engine) as session:
+        rollup.backfill_if_empty(session)
+        roster.load(session)
+    # each worker runs a scheduler, jobs only run on the lease holder
+    scheduler.add_job(
+        jobs.heartbeat,
+        IntervalTrigger(seconds=jobs.RENEW_SECONDS),
+        id="leader_lease",
+        replace_existing=True,
+        next_run_time=datetime.now(),
+    )
     scheduler.add_job(
-        auto_clockout,
+        jobs.leader_only("auto_clockout", auto_clockout),
         CronTrigger(hour=0, minute=0),  # Run at midnight
         id="auto_clockout",
         replace_existing=True,
     )
     scheduler.start()
+    if committer is not None:
+        committer.start()
     yield
+    if committer is not None:
+        committer.stop()
+    await home_assistant.close()
     scheduler.shutdown()
+    jobs.resign()
 
 
 app = FastAPI(lifespan=lifespan, middleware=middleware)
@@ -284,16 +364,89 @@ def admin(request: Request):
         request=request, name="admin.html"
     )
 
+@app.get("/api/stats/cache")
+@requires("admin")
+def cache_stats(request: Request):
+    return {
+        "auth_sessions": session_cache.stats(),
+        "auth_credentials": credential_cache.stats(),
+        "roster": roster.stats(),
+        "group_commit": committer.stats() if committer is not None else None,
+        "reports": report_cache.stats(),
+        "home_assistant": home_assistant.stats(),
+    }
+
+
+@app.get("/metrics")
+@requires("admin")
+def prometheus_metrics(request: Request):
+    body = metrics.render({
+        "auth_sessions": session_cache.stats(),
+        "auth_credentials": credential_cache.stats(),
+        "roster": roster.stats(),
+        "reports": report_cache.stats(),
+    })
+    return PlainTextResponse(body, media_type="text/plain; version=0.0.4")
+
+
+@app.get("/admin/slow-queries", response_class=HTMLResponse)
+@requires("admin", redirect="login")
+def slow_query_log(request: Request):
+    return templates.TemplateResponse(
+        request, "slow_queries.html", context={
+            "enabled": slow_queries is not None,
+            "threshold_ms": slow_queries.threshold * 1000 if slow_queries else None,
+            "total": slow_queries.total if slow_queries else 0,
+            "queries": slow_queries.entries() if slow_queries else [],
+        }
+    )
+
+
+@app.post("/api/slow-queries/clear")
+@requires("admin", redirect="login")
+def clear_slow_queries(request: Request):
+    if slow_queries is not None:
+        slow_queries.clear()
+    return RedirectResponse("/admin/slow-queries", 303)
+
+
+@app.get("/api/jobs")
+@requires("admin")
+def job_runs(request: Request, session: SessionDep):
+    lease = jobs.leader()
+    return {
+        "worker": jobs.WORKER_ID,
+        "leader": lease.owner if lease else None,
+        "runs": jobs.recent_runs(session),
+    }
+
+
+# names are served from the in-memory roster; clients revalidate with the
+# roster's ETag, so an unchanged roster costs a 304
+ROSTER_HEADERS = {"Cache-Control": "private, no-cache"}
+
+
+def roster_not_modified(request: Request) -> Optional[Response]:
+    etag = roster.etag()
+    if etag_matches(request.headers.get("if-none-match", ""), etag):
+        return Response(status_code=304, headers=ROSTER_HEADERS | {"ETag": etag})
+    return None
+
+
 @app.get("/api/whois/{userid_s}", response_class=HTMLResponse)
-def read_items(session: SessionDep, userid_s: str):
+def read_items(request: Request, userid_s: str):
     try:
         userid = int(userid_s)
     except:
         return "Invalid UserId"
-    user = session.exec(select(User).where(User.user == userid)).first()
-    if user:
-        return user.name
-    return "Unknown"
+    not_modified = roster_not_modified(request)
+    if not_modified is not None:
+        return not_modified
+    user = roster.get(userid)
+    return HTMLResponse(
+        user.name if user else "Unknown",
+        headers=ROSTER_HEADERS | {"ETag": roster.etag()},
+    )
 
 # @app.get("/users/active", response_class=HTMLResponse)
 # def read_items(session: SessionDep):
@@ -305,9 +458,17 @@ def read_items(session: SessionDep, userid_s: str):
 
 @app.get("/api/users")
 @requires("authenticated")
-def all_users(request: Request, session: SessionDep):
-    users = session.exec(select(User)).all()
-    return users
+def all_users(request: Request, download: bool = False):
+    """
+    The whole roster, for kiosks to resolve names locally
+    """
+    not_modified = roster_not_modified(request)
+    if not_modified is not None:
+        return not_modified
+    headers = ROSTER_HEADERS | {"ETag": roster.etag()}
+    if download:
+        headers["Content-Disposition"] = "attachment; filename=roster.json"
+    return JSONResponse([entry._asdict() for entry in roster.entries()], headers=headers)
 
 
 @app.post("/users/submit")
@@ -331,48 +492,224 @@ def submit_userid(
         flash(request, f"NO!", "danger")
         return RedirectResponse("/", 303)
 
-    user = session.exec(select(User).where(User.user == userid)).first()
-    if user is None:
+    result = punch_user(session, userid)
+    if result is None:
         flash(request, f"Unknown UserID `{userid}`", "danger")
         return RedirectResponse("/", 303)
 
-    open_session = session.exec(
-        select(Attendance)
-        .where(Attendance.user == userid)
-        .where(Attendance.endedAt.is_(None))
-    ).first()
-
-    if open_session:
-        open_session.endedAt = datetime.now()
-        session.add(open_session)
-        session.commit()
-        flash(request, f"Goodbye {user.name}", "info")
-        return RedirectResponse("/", 303)
+    if result.clocked_in:
+        flash(request, f"Hello {result.name}", "success")
     else:
-        session.add(Attendance(user=userid))
-        session.commit()
-        flash(request, f"Hello {user.name}", "success")
-        return RedirectResponse("/", 303)
+        flash(request, f"Goodbye {result.name}", "info")
+    return RedirectResponse("/", 303)
 
 
-@app.get("/admin/rawdata")
-@requires("admin", redirect="login")
-def data(request: Request, session: SessionDep):
-    data = session.exec(
-        select(Attendance, User).join(User, Attendance.user == User.user, isouter=True)
-    ).all()
+class PunchRequest(BaseModel):
+    userid: str
+
+
+@app.post("/api/punch")
+@requires("authenticated")
+def punch(request: Request, data: PunchRequest, session: SessionDep):
+    try:
+        userid = int(data.userid.strip())
+    except ValueError:
+        return JSONResponse({"error": "Invalid UserID"}, status_code=400)
+
+    if userid > 10_000:
+        return JSONResponse({"error": "NO!"}, status_code=400)
+
+    result = punch_user(session, userid)
+    if result is None:
+        return JSONResponse({"error": f"Unknown UserID `{userid}`"}, status_code=404)
+
+    return {
+        "user": result.user,
+        "name": result.name,
+        "state": "in" if result.clocked_in else "out",
+        "at": result.at.isoformat(),
+    }
+
+
+class BatchPunch(BaseModel):
+    key: str
+    userid: str
+    at: datetime
+
+
+class PunchBatch(BaseModel):
+    punches: List[BatchPunch]
+
+
+PUNCH_BATCH_LIMIT = 500
+
+
+@app.post("/api/punches/batch")
+@requires("authenticated")
+def punch_batch(request: Request, data: PunchBatch, session: SessionDep):
+    """
+    Replay punches a kiosk queued while offline. Each punch carries a
+    client-generated key, so resending a batch after a lost response is safe.
+    """
+    if len(data.punches) > PUNCH_BATCH_LIMIT:
+        return JSONResponse(
+            {"error": f"At most {PUNCH_BATCH_LIMIT} punches per batch"},
+            status_code=400,
+        )
+
+    rejected = {}
+    punches = []
+    for i, p in enumerate(data.punches):
+        if not p.key or len(p.key) > 64:
+            rejected[i] = "Invalid key"
+            continue
+        try:
+            userid = int(p.userid.strip())
+        except ValueError:
+            rejected[i] = "Invalid UserID"
+            continue
+        if userid > 10_000:
+            rejected[i] = "NO!"
+            continue
+        at = p.at
+        if at.tzinfo is not None:
+            at = at.astimezone().replace(tzinfo=None)
+        if at > datetime.now() + timedelta(minutes=5):
+            rejected[i] = "Punch is in the future"
+            continue
+        punches.append((p.key, userid, at))
+
+    results = iter(clock.apply_batch(session, punches))
+
+    out = []
+    for i, p in enumerate(data.punches):
+        if i in rejected:
+            out.append({"key": p.key, "status": "rejected", "error": rejected[i]})
+            continue
+        r = next(results)
+        entry = {"key": r.key, "status": r.status}
+        if r.punch is not None:
+            entry["state"] = "in" if r.punch.clocked_in else "out"
+            entry["name"] = r.punch.name
+        if r.error is not None:
+            entry["error"] = r.error
+        out.append(entry)
+    return {"results": out}
+
+
+def clocked_in_now():
+    with Session(engine) as session:
+        rows = session.exec(
+            select(Attendance, User)
+            .join(User, User.user == Attendance.user)
+            .where(Attendance.endedAt.is_(None))
+            .order_by(Attendance.startedAt.desc())
+        ).all()
+    return [
+        {"user": u.user, "name": u.name, "at": a.startedAt.isoformat()} for a, u in rows
+    ]
 
-    out = io.StringIO()
 
+PRESENCE_KEEPALIVE_SECONDS = 15
+
+
+@app.get("/api/presence/stream")
+@requires("authenticated")
+async def presence_stream(request: Request):
+    """
+    Server-sent events: a "snapshot" of who is clocked in on connect, then
+    "in"/"out" deltas as clock writes commit
+    """
+
+    async def events():
+        async with presence.hub.subscribe() as queue:
+            snapshot = await run_in_threadpool(clocked_in_now)
+            yield f"retry: 5000\nevent: snapshot\ndata: {json.dumps(snapshot)}\n\n"
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), PRESENCE_KEEPALIVE_SECONDS)
+                except TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if event["type"] == "resync":
+                    # fell behind and lost events, start over from the database
+                    snapshot = await run_in_threadpool(clocked_in_now)
+                    yield f"event: snapshot\ndata: {json.dumps(snapshot)}\n\n"
+                    continue
+                yield f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+RAWDATA_BATCH_SIZE = 1000
+
+
+def rawdata_chunks(
+    start: Optional[datetime], end: Optional[datetime], userid: Optional[int], compress: bool
+):
+    """
+    Yield the raw attendance export one batch of rows at a time, optionally
+    as a gzip stream
+    """
+    out = io.StringIO()
     writer = csv.writer(out)
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16) if compress else None
+
+    def flush() -> bytes:
+        chunk = out.getvalue().encode()
+        out.seek(0)
+        out.truncate()
+        if compressor is None:
+            return chunk
+        return compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    # send the header before touching the database so the download starts
     writer.writerow(["user", "start", "end"])
-    for [att, user] in data:
-        writer.writerow([user.name if user else att.user, att.startedAt, att.endedAt])
+    yield flush()
 
-    export_media_type = "text/csv"
-    export_headers = {"Content-Disposition": "attachment; filename=mars-attendance.csv"}
+    query = (
+        select(Attendance, User)
+        .join(User, Attendance.user == User.user, isouter=True)
+        .order_by(Attendance.id)
+    )
+    if start is not None:
+        query = query.where(Attendance.startedAt >= start)
+    if end is not None:
+        query = query.where(Attendance.startedAt < end)
+    if userid is not None:
+        query = query.where(Attendance.user == userid)
+
+    with Session(read_engine) as session:
+        rows = session.exec(query.execution_options(yield_per=RAWDATA_BATCH_SIZE))
+        for batch in rows.partitions():
+            for att, user in batch:
+                writer.writerow([user.name if user else att.user, att.startedAt, att.endedAt])
+            yield flush()
+
+    if compressor is not None:
+        yield compressor.flush()
+
+
+@app.get("/admin/rawdata")
+@requires("admin", redirect="login")
+def data(
+    request: Request,
+    start: Annotated[Optional[datetime], Query(alias="from")] = None,
+    end: Annotated[Optional[datetime], Query(alias="to")] = None,
+    user: Optional[int] = None,
+    gzip: bool = False,
+):
+    filename = "mars-attendance.csv.gz" if gzip else "mars-attendance.csv"
+    export_media_type = "application/gzip" if gzip else "text/csv"
+    export_headers = {"Content-Disposition": f"attachment; filename={filename}"}
     return StreamingResponse(
-        out.getvalue(), headers=export_headers, media_type=export_media_type
+        rawdata_chunks(start, end, user, gzip),
+        headers=export_headers,
+        media_type=export_media_type,
     )
 
 
@@ -396,15 +733,23 @@ def update_entires(request: Request, update: EntryUpdate, session: SessionDep):
     entry = session.exec(select(Attendance).where(Attendance.id == update.id)).first()
     if entry is None:
         print(f"no entry found for id {update.id}")
-        return
+        return JSONResponse({"error": "Entry not found"}, status_code=404)
     
+    rollup.record(session, entry.user, entry.startedAt, entry.endedAt, sign=-1)
     entry.startedAt = startedAt
     entry.endedAt = endedAt
+    rollup.record(session, entry.user, entry.startedAt, entry.endedAt)
 
     session.add(entry)
-    session.commit()
+    try:
+        session.commit()
+    except IntegrityError:
+        session.rollback()
+        return JSONResponse(
+            {"error": "A user can only have one open entry"}, status_code=409
+        )
 
-    return "ok"
+    return entry_json(entry, session.get(User, entry.user))
 
 class EntryCreate(BaseModel):
     userid: int
@@ -434,7 +779,13 @@ def update_entires(request: Request, update: Annotated[EntryCreate, Form()], ses
 
     entry = Attendance(user=update.userid, startedAt=update.startedAt, endedAt=update.endedAt, info=update.info)
     session.add(entry)
-    session.commit()
+    rollup.record(session, entry.user, entry.startedAt, entry.endedAt)
+    try:
+        session.commit()
+    except IntegrityError:
+        session.rollback()
+        flash(request, f"`{user.displayName()}` already has an open time record", "danger")
+        return RedirectResponse(request.headers.get("referer", "/admin/entries"), 303)
 
     flash(request, f"Created time record for `{user.displayName()}`", "success")
     referer = request.headers.get("referer")
@@ -456,113 +807,250 @@ def update_entires(request: Request, id: Annotated[int, Body(embed=True)], sessi
         print(f"no entry found for id {id}")
         return
     
+    rollup.record(session, entry.user, entry.startedAt, entry.endedAt, sign=-1)
     session.delete(entry)
     session.commit()
     
     return "ok"
 
 
+class EntryOperation(BaseModel):
+    op: Literal["create", "update", "delete"]
+    id: Optional[int] = None
+    userid: Optional[int] = None
+    startedAt: Optional[datetime] = None
+    endedAt: Optional[datetime] = None
+    info: Optional[str] = None
+
+
+class EntryBulk(BaseModel):
+    operations: List[EntryOperation]
+
+
+ENTRIES_BULK_LIMIT = 500
+
+
+@app.post("/api/entries/bulk")
+@requires("admin")
+def bulk_entries(request: Request, data: EntryBulk, session: SessionDep):
+    """
+    Apply a batch of entry edits in one transaction. Everything is checked
+    before anything is written; if any operation is invalid, none are applied
+    and the errors come back by index. Updates set both times like
+    /api/entries/update, so an update without endedAt reopens the entry.
+    """
+    ops = data.operations
+    if len(ops) > ENTRIES_BULK_LIMIT:
+        return JSONResponse(
+            {"error": f"At most {ENTRIES_BULK_LIMIT} operations per request"},
+            status_code=400,
+        )
+
+    for op in ops:
+        for field in ["startedAt", "endedAt"]:
+            value = getattr(op, field)
+            if value is not None and value.tzinfo is not None:
+                setattr(op, field, value.astimezone().replace(tzinfo=None))
+
+    ids = [op.id for op in ops if op.op != "create"]
+    entries = {
+        a.id: a for a in session.exec(select(Attendance).where(Attendance.id.in_(ids))).all()
+    }
+    userids = {op.userid for op in ops if op.op == "create"}
+    users = {u.user for u in session.exec(select(User).where(User.user.in_(userids))).all()}
+
+    errors = []
+    seen = set()
+    for i, op in enumerate(ops):
+        if op.op != "create":
+            if op.id is None or op.id not in entries:
+                errors.append({"index": i, "error": f"No entry with id {op.id}"})
+                continue
+            if op.id in seen:
+                errors.append({"index": i, "error": f"Entry {op.id} appears more than once"})
+                continue
+            seen.add(op.id)
+        if op.op == "create" and op.userid not in users:
+            errors.append({"index": i, "error": f"Unknown UserID `{op.userid}`"})
+        if op.op != "delete":
+            if op.startedAt is None:
+                errors.append({"index": i, "error": "startedAt is required"})
+            elif op.endedAt is not None and op.endedAt < op.startedAt:
+                errors.append({"index": i, "error": "endedAt is before startedAt"})
+    if errors:
+        return JSONResponse({"errors": errors}, status_code=400)
+
+    removed = []
+    added = []
+    changed = []
+    deleted = []
+    for op in ops:
+        if op.op == "create":
+            entry = Attendance(
+                user=op.userid, startedAt=op.startedAt, endedAt=op.endedAt, info=op.info
+            )
+            session.add(entry)
+            changed.append(entry)
+        else:
+            entry = entries[op.id]
+            removed.append((entry.user, entry.startedAt, entry.endedAt))
+            if op.op == "delete":
+                session.delete(entry)
+                deleted.append(entry.id)
+                continue
+            entry.startedAt = op.startedAt
+            entry.endedAt = op.endedAt
+            if op.info is not None:
+                entry.info = op.info
+            session.add(entry)
+            changed.append(entry)
+        added.append((entry.user, entry.startedAt, entry.endedAt))
+
+    rollup.record_many(session, removed, sign=-1)
+    rollup.record_many(session, added)
+    try:
+        session.commit()
+    except IntegrityError:
+        session.rollback()
+        return JSONResponse(
+            {"error": "A user can only have one open entry"}, status_code=409
+        )
+
+    names = {
+        u.user: u
+        for u in session.exec(select(User).where(User.user.in_({e.user for e in changed}))).all()
+    }
+    return {
+        "entries": [entry_json(e, names.get(e.user)) for e in changed],
+        "deleted": deleted,
+    }
+
+
+# report bodies are cached until the data they cover changes (see reports.py);
+# pages are still rendered per request since they carry flash messages
+REPORT_HEADERS = {"Cache-Control": "private, no-cache"}
+
+
+def report_key(session: Session, name: str, year: int):
+    return (name, year, data_version(session, year_scope(year), USERS))
+
+
+def report_not_modified(request: Request, tag: str) -> Optional[Response]:
+    # a 304 would swallow any pending flash messages
+    if "_messages" in request.session:
+        return None
+    if etag_matches(request.headers.get("if-none-match", ""), tag):
+        return Response(status_code=304, headers=REPORT_HEADERS | {"ETag": tag})
+    return None
+
+
 @app.get("/admin/entries")
 @requires("admin", redirect="login")
-def data(request: Request, session: SessionDep, year: Optional[int] = None):
+def data(request: Request, session: ReadSessionDep, year: Optional[int] = None):
     if year is None:
         year = datetime.now().year
-    
-    year_start = datetime(year=year, month=1, day=1)
-    year_end = datetime(year=year + 1, month=1, day=1)
 
     users = session.exec(
         select(User)
         .where(User.active == True)
         .order_by(User.name)
     ).all()
-    
-    attendance = session.exec(
-        select(Attendance, User)
-        .join(User, User.user == Attendance.user)
-        .where(Attendance.startedAt >= year_start)
-        .where(Attendance.startedAt < year_end)
-        .order_by(Attendance.startedAt.desc())
-    ).all()
-    
-    available_years = session.exec(
-        select(func.distinct(func.strftime('%Y', Attendance.startedAt)))
-        .order_by(func.strftime('%Y', Attendance.startedAt).desc())
-    ).all()
-
-    datetimeToHtml = lambda dt: dt.strftime("%Y-%m-%d %H:%M")
-
-    table = ""
-
-    dayFormat = lambda dt: dt.strftime("%A, %Y-%-m-%d")
-    groups_by_day = itertools.groupby(attendance, lambda v: dayFormat(v[0].startedAt))
-
-    for day, day_items in groups_by_day:
-        table += '<th colspan="6">' + day + "</th>"
-        for atnd, user in day_items:
-            table += '<tr data-id="' + str(atnd.id) + '">'
-            table += "<td>"
-            table += user.displayName()
-            table += "</td>"
-            table += "<td>"
-            if atnd.startedAt is not None:
-                table += (
-                    '<input name="startedAt" type="datetime-local" value="'
-                    + datetimeToHtml(atnd.startedAt)
-                    + '">'
-                )
-            else:
-                table += "None"
-            table += "</td>"
-            table += "<td>"
-            if atnd.endedAt is not None:
-                table += (
-                    '<input name="endedAt" type="datetime-local" value="'
-                    + datetimeToHtml(atnd.endedAt)
-                    + '">'
-                )
-                table += '<button type="button" class="btn btn-sm btn-outline-danger ms-1" onclick="clearEndEntry(this)" title="Clear end time">✕</button>'
-            else:
-                table += "None"
-            table += f"<td>{atnd.info or ""}</td>"
-            table += "</td>"
-            table += "<td>"
-            table += '<button type="button" class="btn btn-outline-primary" onclick="updateEntry(this)">Update</button>'
-            table += "</td>"
-            table += "<td>"
-            table += '<button type="button" class="btn btn-outline-danger" onclick="deleteEntry(this)">Delete</button>'
-            table += "</td>"
-            table += "</tr>"
 
+    # rows are loaded a page at a time from /api/entries as you scroll
     return templates.TemplateResponse(
         request, "entries.html", context={
-            "tableBody": table,
             "current_year": year,
-            "available_years": [int(y) for y in available_years if y],
+            "available_years": available_years(session),
             "users": users,
         }
     )
 
 
-def round_down_to_week_start(dt):
-    # Get the start of the week (Monday)
-    start_of_week = dt - timedelta(days=dt.weekday())
-    # Set time to midnight
-    return start_of_week.replace(hour=0, minute=0, second=0, microsecond=0)
+def entry_json(atnd: Attendance, user: Optional[User]):
+    return {
+        "id": atnd.id,
+        "user": atnd.user,
+        "name": user.displayName() if user else str(atnd.user),
+        "startedAt": atnd.startedAt.isoformat(),
+        "endedAt": atnd.endedAt.isoformat() if atnd.endedAt else None,
+        "info": atnd.info,
+    }
+
+
+ENTRIES_PAGE_SIZE = 200
+
+
+@app.get("/api/entries")
+@requires("admin")
+def entries(
+    request: Request,
+    session: ReadSessionDep,
+    start: Annotated[Optional[datetime], Query(alias="from")] = None,
+    end: Annotated[Optional[datetime], Query(alias="to")] = None,
+    user: Optional[int] = None,
+    after: Optional[str] = None,
+    limit: int = ENTRIES_PAGE_SIZE,
+):
+    """
+    Entries newest first, a page at a time. Pass the previous page's `next`
+    as `after` to continue; it's the (startedAt, id) of the last row, so a
+    page costs the same however deep into the year it is.
+    """
+    limit = max(1, min(limit, 1000))
+    query = (
+        select(Attendance, User)
+        .join(User, User.user == Attendance.user, isouter=True)
+        .order_by(Attendance.startedAt.desc(), Attendance.id.desc())
+        .limit(limit)
+    )
+    if start is not None:
+        query = query.where(Attendance.startedAt >= start)
+    if end is not None:
+        query = query.where(Attendance.startedAt < end)
+    if user is not None:
+        query = query.where(Attendance.user == user)
+    if after is not None:
+        try:
+            after_start, after_id = after.rsplit(",", 1)
+            cursor = tuple_(datetime.fromisoformat(after_start), int(after_id))
+        except ValueError:
+            return JSONResponse({"error": "Invalid cursor"}, status_code=400)
+        query = query.where(tuple_(Attendance.startedAt, Attendance.id) < cursor)
+
+    rows = session.exec(query).all()
+    next_cursor = None
+    if len(rows) == limit:
+        last = rows[-1][0]
+        next_cursor = f"{last.startedAt.isoformat()},{last.id}"
+    return {"entries": [entry_json(a, u) for a, u in rows], "next": next_cursor}
+
+
+def timeFormat(td: timedelta):
+    if td.total_seconds() == 0:
+        return ""
+    else:
+        return str(round(td.total_seconds() / 60 / 60, 1))
+
+
+weekFormat = lambda dt: dt.strftime("%Y-%-m-%d")
+dayFormat = lambda dt: dt.strftime("%a %m/%d")
+
+
+class WeekTable(NamedTuple):
+    users: List[str]
+    # (week, hours per user)
+    weeks: List[Tuple[str, List[str]]]
 
 
-def make_week_time_table(session: SessionDep, fmt: str, year: int) -> str:
-    csv = fmt == "csv"
+def make_week_time_table(session: Session, year: int) -> WeekTable:
     year_start = datetime(year=year, month=1, day=1)
     year_end = datetime(year=year + 1, month=1, day=1)
     
-    attendance = session.exec(
-        select(Attendance, User)
-        .join(User, User.user == Attendance.user)
-        .where(Attendance.endedAt.isnot(None))
-        .where(Attendance.startedAt >= year_start)
-        .where(Attendance.startedAt < year_end)
-        .order_by(Attendance.startedAt.desc())
+    daily = session.exec(
+        select(DailyTotal, User)
+        .join(User, User.user == DailyTotal.user)
+        .where(DailyTotal.day >= year_start.date())
+        .where(DailyTotal.day < year_end.date())
     ).all()
     users = session.exec(
         select(User)
@@ -571,199 +1059,183 @@ def make_week_time_table(session: SessionDep, fmt: str, year: int) -> str:
         .order_by(User.user)
     ).all()
 
-    table = ""
-
-    def timeFormat(td: timedelta):
-        if td.total_seconds() == 0:
-            return ""
-        else:
-            return str(round(td.total_seconds() / 60 / 60, 1))
-
-    weekFormat = lambda dt: dt.strftime("%Y-%-m-%d")
-    weeks = itertools.groupby(
-        attendance, lambda v: round_down_to_week_start(v[0].startedAt)
+    report = Aggregate.from_days(
+        (user.displayName(), total.day, timedelta(seconds=total.seconds))
+        for total, user in daily
+    )
+    return WeekTable(
+        [user.name for user in users],
+        [
+            (weekFormat(week), [timeFormat(report.week_total(user.displayName(), week)) for user in users])
+            for week in report.active_weeks()
+        ],
     )
 
-    user_timelines = defaultdict(lambda: Timeline())
-    for atnd, user in attendance:
-        user_timelines[user.displayName()].add(
-            atnd.startedAt, atnd.endedAt or datetime.now()
-        )
-
-    if csv:
-        table += "week"
-    else:
-        table += "<tr>"
-        table += '<th scope="col">Week</th>'
-    for user in users:
-        if csv:
-            table += f',"{user.name.replace('"', '""')}"'
-        else:
-            table += '<th scope="col">' + user.name + "</th>"
-    table += "\n" if csv else "</tr>\n"
-    for week, week_items in weeks:
-        user_attendance = {}
-        for user, tl in sorted(user_timelines.items(), key=lambda v: v[0]):
-            week_total = sum(
-                map(lambda s: s.end - s.start, tl.slice_week_cc(week)),
-                start=timedelta(),
-            )
-
-            user_attendance[user] = week_total
 
-        if csv:
-            table += weekFormat(week)
-        else:
-            table += "<tr>"
-            # week column
-            table += '<th scope="row">' + weekFormat(week) + "</th>"
-        for user in users:
-            table += "," if csv else "<td>"
-            if user.displayName() not in user_attendance:
-                table += "" if csv else "</td>"
-                continue
-            table += timeFormat(user_attendance[user.displayName()])
-            table += "" if csv else "</td>"
-        table += "\n" if csv else "</tr>"
-    return table
+def week_time_table_csv(table: WeekTable) -> str:
+    header = "week"
+    for name in table.users:
+        quoted = name.replace('"', '""')
+        header += f',"{quoted}"'
+    lines = [header] + [week + "".join("," + h for h in hours) for week, hours in table.weeks]
+    return "\n".join(lines) + "\n"
 
 
 @app.get("/admin/time/weeks")
 @requires("admin", redirect="login")
-def time_table_week(request: Request, session: SessionDep, year: Optional[int] = None):
+def time_table_week(request: Request, session: ReadSessionDep, year: Optional[int] = None):
     if year is None:
         year = datetime.now().year
-    
-    table = make_week_time_table(session, "html", year)
-    
-    available_years = session.exec(
-        select(func.distinct(func.strftime('%Y', Attendance.startedAt)))
-        .order_by(func.strftime('%Y', Attendance.startedAt).desc())
-    ).all()
 
-    return templates.TemplateResponse(
+    key = report_key(session, "weeks", year)
+    # the year picker is on the page too, and other years don't bump this one's version
+    years = available_years(session)
+    tag = report_etag((*key, "html", tuple(years)))
+    not_modified = report_not_modified(request, tag)
+    if not_modified is not None:
+        return not_modified
+    table = report_cache.get(key, lambda: make_week_time_table(session, year))
+
+    return stream_template(
         request,
         "time_table.html",
         context={
-            "tableBody": table,
+            "table_template": "time_table_weeks.frag.html",
+            "table": table,
             "bodyHeader": f'<a type="button" class="btn btn-outline-primary" href="/admin/time/weeks/csv?year={year}">Download as CSV</a>',
             "current_year": year,
-            "available_years": [int(y) for y in available_years if y],
+            "available_years": years,
         },
+        headers=REPORT_HEADERS | {"ETag": tag},
     )
 
 
 @app.get("/admin/time/weeks/csv")
 @requires("admin", redirect="login")
-def time_table_week_csv(request: Request, session: SessionDep, year: Optional[int] = None):
+def time_table_week_csv(request: Request, session: ReadSessionDep, year: Optional[int] = None):
     if year is None:
         year = datetime.now().year
-    
-    table = make_week_time_table(session, "csv", year)
+
+    key = report_key(session, "weeks", year)
+    tag = report_etag((*key, "csv"))
+    not_modified = report_not_modified(request, tag)
+    if not_modified is not None:
+        return not_modified
+    table = week_time_table_csv(
+        report_cache.get(key, lambda: make_week_time_table(session, year))
+    )
 
     export_media_type = "text/csv"
     export_headers = {
         "Content-Disposition": "attachment; filename=mars-attendance-weekly.csv"
     }
-    return StreamingResponse(
-        table, headers=export_headers, media_type=export_media_type
+    return Response(
+        table,
+        headers=REPORT_HEADERS | export_headers | {"ETag": tag},
+        media_type=export_media_type,
     )
 
 
-@app.get("/admin/time")
-@requires("admin", redirect="login")
-def time_table(request: Request, session: SessionDep, year: Optional[int] = None):
-    if year is None:
-        year = datetime.now().year
-    
+class DayTable(NamedTuple):
+    # the totals are small next to the rendered table, so that's what gets
+    # cached, and each week's rows are built as the template reaches them
+    report: Aggregate
+    users: List[str]
+
+    def weeks(self) -> Iterator[Tuple[str, List[str], List[Tuple[str, List[str]]]]]:
+        """
+        (week, day headings, [(user, hours per day + week total + year total)])
+        """
+        report = self.report
+        for week in report.active_weeks():
+            user_attendance = []
+            for user in self.users:
+                days = [report.day_total(user, week + timedelta(days=day)) for day in range(7)]
+                week_total = report.week_total(user, week)
+                year_total = report.running_total(user, week)
+
+                user_attendance.append(
+                    (str(user), [timeFormat(a) for a in [*days, week_total, year_total]])
+                )
+
+            yield (
+                weekFormat(week),
+                [dayFormat(week + timedelta(days=dayi)) for dayi in range(0, 7)],
+                user_attendance,
+            )
+
+
+def time_table_body(session: Session, year: int) -> DayTable:
     year_start = datetime(year=year, month=1, day=1)
     year_end = datetime(year=year + 1, month=1, day=1)
     
-    attendance = session.exec(
+    daily = session.exec(
+        select(DailyTotal, User)
+        .join(User, User.user == DailyTotal.user)
+        .where(User.active == True)
+        .where(DailyTotal.day >= year_start.date())
+        .where(DailyTotal.day < year_end.date())
+    ).all()
+    # open sessions aren't in the rollup yet, count them up to now
+    open_sessions = session.exec(
         select(Attendance, User)
         .join(User, User.user == Attendance.user)
         .where(User.active == True)
-        .where(Attendance.startedAt >= year_start)
+        .where(Attendance.endedAt.is_(None))
         .where(Attendance.startedAt < year_end)
-        .order_by(Attendance.startedAt.desc())
-    ).all()
-    
-    available_years = session.exec(
-        select(func.distinct(func.strftime('%Y', Attendance.startedAt)))
-        .order_by(func.strftime('%Y', Attendance.startedAt).desc())
     ).all()
 
-    table = ""
-
-    def timeFormat(td: timedelta):
-        if td.total_seconds() == 0:
-            return ""
-        else:
-            return str(round(td.total_seconds() / 60 / 60, 1))
-
-    dayFormat = lambda dt: dt.strftime("%a %m/%d")
-    weekFormat = lambda dt: dt.strftime("%Y-%-m-%d")
-    weeks = itertools.groupby(
-        attendance, lambda v: round_down_to_week_start(v[0].startedAt)
+    report = Aggregate.from_days(
+        (user.displayName(), total.day, timedelta(seconds=total.seconds))
+        for total, user in daily
     )
+    now = datetime.now()
+    for atnd, user in open_sessions:
+        report.add(user.displayName(), max(atnd.startedAt, year_start), min(now, year_end))
 
-    user_timelines = defaultdict(lambda: Timeline())
-    for atnd, user in attendance:
-        user_timelines[user.displayName()].add(atnd.startedAt, atnd.endedAt or datetime.now())
-    
-    year_dt = datetime(year=year, month=1, day=1)
-    # end_of_year = datetime(year=year + 1, month=1, day=1) - timedelta(
-    #     microseconds=1
-    # )
-
-    for week, week_items in weeks:
-        end_of_week = week + timedelta(days=7) - timedelta(microseconds=1)
-        user_attendance = {}
-        for user, tl in sorted(user_timelines.items(), key=lambda v:v[0]):
-            days = []
-            for day in range(7):
-                slices = tl.slice_day_cc(week + timedelta(days=day))
-                days.append(
-                    sum(map(lambda s: s.end - s.start, slices), start=timedelta())
-                )
-
-            week_total = sum(
-                map(lambda s: s.end - s.start, tl.slice_week_cc(week)),
-                start=timedelta(),
-            )
-            year_total = sum(
-                map(lambda s: s.end - s.start, tl.slice_between_cc(year_dt, end_of_week)),
-                start=timedelta(),
-            )
+    users = sorted(report.keys())
+    # running totals are built on first use, do it now rather than from
+    # several renders of a cached table at once
+    for user in users:
+        report.running_total(user, year_start.date())
+    return DayTable(report, users)
 
-            user_attendance[user] = [*days, week_total, year_total]
 
-        table += "<tr>"
-        table += '<th scope="col">' + weekFormat(week) + "</th>"
-        for dayi in range(0, 7):
-            table += (
-                '<th scope="col">' + dayFormat(week + timedelta(days=dayi)) + "</th>"
-            )
-        table += '<th scope="col">Week Total</th>'
-        table += '<th scope="col">Year Total</th>'
-        table += "</tr>"
-        for user, atnd in user_attendance.items():
-            table += "<tr>"
-            table += '<th scope="row">'
-            table += str(user)
-            table += "</th>"
-            for a in atnd:
-                table += "<td>"
-                table += timeFormat(a)
-                table += "</td>"
-            table += "</tr>"
+@app.get("/admin/time")
+@requires("admin", redirect="login")
+def time_table(request: Request, session: ReadSessionDep, year: Optional[int] = None):
+    if year is None:
+        year = datetime.now().year
 
-    return templates.TemplateResponse(
+    # open sessions count up to now, so the table changes by the minute
+    year_end = datetime(year=year + 1, month=1, day=1)
+    clocked_in = session.exec(
+        select(Attendance.id)
+        .where(Attendance.endedAt.is_(None))
+        .where(Attendance.startedAt < year_end)
+    ).first()
+    years = available_years(session)
+    if clocked_in is not None:
+        table = time_table_body(session, year)
+        headers = {}
+    else:
+        key = report_key(session, "time", year)
+        # the year picker is on the page too, see time_table_week
+        tag = report_etag((*key, "html", tuple(years)))
+        not_modified = report_not_modified(request, tag)
+        if not_modified is not None:
+            return not_modified
+        table = report_cache.get(key, lambda: time_table_body(session, year))
+        headers = REPORT_HEADERS | {"ETag": tag}
+
+    return stream_template(
         request, "time_table.html", context={
-            "tableBody": table,
+            "table_template": "time_table_days.frag.html",
+            "table": table,
             "current_year": year,
-            "available_years": [int(y) for y in available_years if y],
-        }
+            "available_years": years,
+        },
+        headers=headers,
     )
 
 
@@ -777,16 +1249,10 @@ class ClockoutAllFormData(BaseModel):
 def clockout_all(
     request: Request, session: SessionDep, data: Annotated[ClockoutAllFormData, Form()]
 ):
-    sessions = session.exec(
-        select(Attendance)
-        .where(Attendance.endedAt.is_(None))
-        .order_by(Attendance.startedAt.desc())
-    ).all()
-
-    for ses in sessions:
-        ses.endedAt = datetime.combine(data.date, data.time)
-        session.add(ses)
+    sessions = clock.close_all_open(session, datetime.combine(data.date, data.time))
     session.commit()
+    for ses in sessions:
+        presence.clocked_out(ses.user)
     flash(request, f"Clocked out {len(sessions)} users", "success")
     return RedirectResponse("/admin", 303)
 
@@ -802,6 +1268,7 @@ def create_user(request: Request, data: Annotated[UserCreate, Form()], session:
     user = User(user=data.user, name=data.name)
     session.add(user)
     session.commit()
+    roster.invalidate()
     
     flash(request, f"Created user {user.displayName()}", "success")
     return RedirectResponse("/admin/users/edit", 303)
@@ -818,6 +1285,7 @@ def update_user(request: Request, data: UserUpdate, session: SessionDep):
     user.active = data.active
     session.add(user)
     session.commit()
+    roster.invalidate()
     
     return PlainTextResponse("ok")
 
@@ -832,6 +1300,7 @@ def deactivate_user(request: Request, data: UserDelete, session: SessionDep):
     user.active = False
     session.add(user)
     session.commit()
+    roster.invalidate()
     return PlainTextResponse("ok")
 
 
@@ -847,37 +1316,37 @@ def delete_user(request: Request, data: UserDelete, session: SessionDep):
         session.delete(user)
     
     session.commit()
+    invalidate_user(data.user)
+    roster.invalidate()
     return PlainTextResponse("ok")
 
 
+FANS_ENTITY = "switch.all_automatic_outlets"
+
+
+async def switch_fans(request: Request, service: str, action: str):
+    try:
+        response = await home_assistant.call_service(
+            "switch", service, {"entity_id": FANS_ENTITY}
+        )
+    except HomeAssistantError as e:
+        print(f"fans {action} failed: {e}")
+        flash(request, f"Failed to turn {action} fans: {e}", "error")
+    else:
+        if not response.is_success:
+            flash(request, f"Failed to turn {action} fans: {response.status_code}", "error")
+
+    return RedirectResponse(request.headers.get("referer", "/admin/entries"), 303)
+
+
 @app.post("/api/fans/on")
 @requires("authenticated")
-def fans_on(request: Request):
+async def fans_on(request: Request):
     print("fans on")
-    
-    url = f"{HA_URL}/api/services/switch/turn_on"
-    headers = {"Authorization": f"Bearer {HA_TOKEN}"}
-    data = {"entity_id": "switch.all_automatic_outlets"}
-
-    response = requests.post(url, headers=headers, json=data)
-    print(response.text)
-    if not response.ok:
-        flash(request, f"Failed to turn on fans: {response.status_code}", "error")
-
-    return RedirectResponse(request.headers.get("referer"), 303)
+    return await switch_fans(request, "turn_on", "on")
 
 @app.post("/api/fans/off")
 @requires("authenticated")
-def fans_off(request: Request):
+async def fans_off(request: Request):
     print("fans off")
-    
-    url = f"{HA_URL}/api/services/switch/turn_off"
-    headers = {"Authorization": f"Bearer {HA_TOKEN}"}
-    data = {"entity_id": "switch.all_automatic_outlets"}
-
-    response = requests.post(url, headers=headers, json=data)
-    print(response.text)
-    if not response.ok:
-        flash(request, f"Failed to turn off fans: {response.status_code}", "error")
-
-    return RedirectResponse(request.headers.get("referer"), 303)
+    return await switch_fans(request, "turn_off", "off")
@@ -0,0 +1,202 @@
+from bisect import bisect_left
+from contextvars import ContextVar
+from threading import Lock
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import Engine, event
+
+# seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 500)
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: Sequence[str], values: Sequence[Any], extra: Optional[str] = None) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values: Dict[Tuple, float] = {}
+        self._lock = Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels[n] for n in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(
+        self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS
+    ):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # label values -> (count per bucket with +Inf last, sum)
+        self._values: Dict[Tuple, Tuple[List[int], float]] = {}
+        self._lock = Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels[n] for n in self.labels)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * (len(self.buckets) + 1), 0.0)
+            counts[bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip([*self.buckets, "+Inf"], counts):
+                    cumulative += count
+                    le = f'le="{bound}"'
+                    lines.append(f"{self.name}_bucket{_labels(self.labels, key, le)} {cumulative}")
+                lines.append(f"{self.name}_sum{_labels(self.labels, key)} {total}")
+                lines.append(f"{self.name}_count{_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+request_seconds = Histogram(
+    "attendance_request_seconds", "Time to handle a request, including streaming the body",
+    ["method", "route", "status"],
+)
+request_queries = Histogram(
+    "attendance_request_sql_queries", "SQL statements run per request", ["route"], COUNT_BUCKETS
+)
+request_sql_seconds = Histogram(
+    "attendance_request_sql_seconds", "Time spent in SQL per request", ["route"]
+)
+sql_seconds = Histogram("attendance_sql_seconds", "Time per SQL statement", ["operation"])
+auth_seconds = Histogram(
+    "attendance_authenticate_seconds", "Time in BasicAuthBackend.authenticate"
+)
+job_seconds = Histogram(
+    "attendance_job_seconds", "Scheduled job run time", ["job"], (0.01, 0.1, 1, 10, 60, 300)
+)
+job_runs = Counter("attendance_job_runs_total", "Scheduled job runs", ["job", "result"])
+
+METRICS = [
+    request_seconds,
+    request_queries,
+    request_sql_seconds,
+    sql_seconds,
+    auth_seconds,
+    job_seconds,
+    job_runs,
+]
+
+
+class RequestStats:
+    __slots__ = ("queries", "sql_seconds", "scope")
+
+    def __init__(self, scope: Optional[dict] = None):
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.scope = scope
+
+    @property
+    def route(self) -> str:
+        # routing fills scope["route"] in place before the handler runs
+        if self.scope is None:
+            return "unmatched"
+        route = self.scope.get("route")
+        return getattr(route, "path", None) or self.scope.get("path", "unmatched")
+
+
+# set per request by MetricsMiddleware. Starlette copies the context into the
+# threadpool, so sync handlers add to the same object.
+current_request: ContextVar[Optional[RequestStats]] = ContextVar("current_request", default=None)
+
+
+def instrument(engine: Engine):
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        # kept on the statement's context, not the connection, so one that
+        # fails and never reaches after_cursor_execute leaves nothing behind
+        context._query_started = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - context._query_started
+        sql_seconds.observe(elapsed, operation=statement.lstrip().split(None, 1)[0].upper())
+        stats = current_request.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.sql_seconds += elapsed
+
+
+class MetricsMiddleware:
+    """
+    Times every HTTP request under its route template (/api/whois/{userid_s},
+    not the literal path, so the label count stays bounded).
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        stats = RequestStats(scope)
+        token = current_request.set(stats)
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            path = getattr(scope.get("route"), "path", "unmatched")
+            request_seconds.observe(
+                time.perf_counter() - start, method=scope["method"], route=path, status=status
+            )
+            request_queries.observe(stats.queries, route=path)
+            request_sql_seconds.observe(stats.sql_seconds, route=path)
+            current_request.reset(token)
+
+
+def render(caches: Dict[str, Dict[str, Any]]) -> str:
+    """
+    Everything in Prometheus text format. `caches` are the stats() of the
+    in-process caches, exported as gauges.
+    """
+    lines = []
+    for metric in METRICS:
+        lines += metric.render()
+    for stat, kind, help in [
+        ("hits", "counter", "Cache hits"),
+        ("misses", "counter", "Cache misses"),
+        ("size", "gauge", "Entries in the cache"),
+    ]:
+        name = f"attendance_cache_{stat}" + ("_total" if kind == "counter" else "")
+        lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+        for cache, stats in caches.items():
+            if stat in stats:
+                lines.append(f"{name}{_labels(['cache'], [cache])} {stats[stat]}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,165 @@
+from datetime import datetime
+from typing import Callable, List
+
+from sqlalchemy import Connection
+from sqlalchemy.exc import IntegrityError
+
+from aggregate import split_days
+
+
+def _attendance_started_index(conn: Connection):
+    # reports filter and sort on startedAt
+    conn.exec_driver_sql(
+        'CREATE INDEX IF NOT EXISTS "ix_attendance_startedAt_user" '
+        'ON attendance ("startedAt", user)'
+    )
+
+
+def _user_name_index(conn: Connection):
+    # try_login matches on the name as well as the id
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_user_name ON user (name)")
+
+
+def _attendance_year(conn: Connection):
+    # computed on read, so it can't go stale; the index makes the year
+    # dropdown a scan of the index instead of strftime over every row
+    columns = [row[1] for row in conn.exec_driver_sql("PRAGMA table_info(attendance)")]
+    if "year" not in columns:
+        conn.exec_driver_sql(
+            "ALTER TABLE attendance ADD COLUMN year INTEGER "
+            """GENERATED ALWAYS AS (CAST(strftime('%Y', "startedAt") AS INTEGER)) VIRTUAL"""
+        )
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_attendance_year ON attendance (year)")
+
+
+def _close_duplicate_open_sessions(conn: Connection):
+    """
+    Before the index, a racing double swipe could leave a user with two open
+    sessions. Close all but the newest where the newest starts, as clocking
+    in again would have, and add them to the daily totals unless those are
+    still to be backfilled.
+    """
+    rows = conn.exec_driver_sql(
+        'SELECT id, user, "startedAt" FROM attendance WHERE "endedAt" IS NULL '
+        'AND user IN (SELECT user FROM attendance WHERE "endedAt" IS NULL '
+        'GROUP BY user HAVING count(*) > 1) ORDER BY user, "startedAt" DESC, id DESC'
+    ).all()
+    rollup = conn.exec_driver_sql("SELECT 1 FROM dailytotal LIMIT 1").first() is not None
+    newest = {}
+    for id, user, started in rows:
+        if user not in newest:
+            newest[user] = started
+            continue
+        conn.exec_driver_sql(
+            'UPDATE attendance SET "endedAt" = ?, info = coalesce(info, ?) WHERE id = ?',
+            (newest[user], "closed duplicate open session", id),
+        )
+        if not rollup:
+            continue
+        for day, duration in split_days(
+            datetime.fromisoformat(started), datetime.fromisoformat(newest[user])
+        ):
+            conn.exec_driver_sql(
+                "INSERT INTO dailytotal (user, day, seconds) VALUES (?, ?, ?) "
+                "ON CONFLICT (user, day) DO UPDATE SET seconds = seconds + excluded.seconds",
+                (user, day.isoformat(), duration.total_seconds()),
+            )
+    if len(rows):
+        print(f"[migrations] closed {len(rows) - len(newest)} duplicate open sessions")
+
+
+def _attendance_open_index(conn: Connection):
+    # see clock.toggle
+    _close_duplicate_open_sessions(conn)
+    conn.exec_driver_sql(
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_attendance_open_user "
+        'ON attendance (user) WHERE "endedAt" IS NULL'
+    )
+
+
+def _bump(years_select: str) -> str:
+    return (
+        "INSERT INTO dataversion (scope, version) "
+        f"SELECT 'year:' || y, 1 FROM ({years_select}) WHERE y IS NOT NULL "
+        "ON CONFLICT (scope) DO UPDATE SET version = version + 1;"
+    )
+
+
+def _years(row: str) -> str:
+    return (
+        f"""SELECT strftime('%Y', {row}."startedAt") AS y """
+        f"""UNION SELECT strftime('%Y', {row}."endedAt")"""
+    )
+
+
+def _data_version_triggers(conn: Connection):
+    # report caches key on these (see reports.py). Triggers rather than the
+    # write paths so other workers and hand-written SQL bump them too.
+    triggers = {
+        "attendance_version_insert": ("AFTER INSERT ON attendance", _bump(_years("NEW"))),
+        "attendance_version_update": (
+            "AFTER UPDATE ON attendance",
+            _bump(_years("OLD") + " UNION " + _years("NEW")),
+        ),
+        "attendance_version_delete": ("AFTER DELETE ON attendance", _bump(_years("OLD"))),
+    }
+    users = (
+        "INSERT INTO dataversion (scope, version) VALUES ('users', 1) "
+        "ON CONFLICT (scope) DO UPDATE SET version = version + 1;"
+    )
+    for table in ["user", "authuser"]:
+        for op in ["INSERT", "UPDATE", "DELETE"]:
+            triggers[f"{table}_version_{op.lower()}"] = (f"AFTER {op} ON {table}", users)
+
+    for name, (when, body) in triggers.items():
+        conn.exec_driver_sql(f"CREATE TRIGGER IF NOT EXISTS {name} {when} BEGIN {body} END")
+
+
+def _auth_version_triggers(conn: Connection):
+    # auth.py caches sessions and credentials per worker and drops them when
+    # this moves, so a logout or password change reaches every worker
+    bump = (
+        "INSERT INTO dataversion (scope, version) VALUES ('auth', 1) "
+        "ON CONFLICT (scope) DO UPDATE SET version = version + 1;"
+    )
+    triggers = {
+        "authsession_auth_version_delete": "AFTER DELETE ON authsession",
+        "authuser_auth_version_update": "AFTER UPDATE ON authuser",
+        "authuser_auth_version_delete": "AFTER DELETE ON authuser",
+    }
+    for name, when in triggers.items():
+        conn.exec_driver_sql(f"CREATE TRIGGER IF NOT EXISTS {name} {when} BEGIN {bump} END")
+
+
+# append only, the position is the schema version
+MIGRATIONS: List[Callable[[Connection], None]] = [
+    _attendance_started_index,
+    _user_name_index,
+    _attendance_year,
+    _attendance_open_index,
+    _data_version_triggers,
+    _auth_version_triggers,
+]
+
+
+def migrate(conn: Connection):
+    """
+    Bring the schema up to date, tracked in PRAGMA user_version. Runs after
+    create_all, so new tables already exist and the steps only need to cover
+    what create_all won't do to an existing database.
+
+    The caller holds the write lock (BEGIN IMMEDIATE) and commits, so workers
+    starting together take turns and later ones find nothing left to do.
+    """
+    version = conn.exec_driver_sql("PRAGMA user_version").scalar()
+    for number, step in enumerate(MIGRATIONS[version:], start=version + 1):
+        savepoint = conn.begin_nested()
+        try:
+            step(conn)
+        except IntegrityError:
+            savepoint.rollback()
+            print(f"[migrations] {step.__name__} failed, existing rows violate it")
+            return
+        savepoint.commit()
+        conn.exec_driver_sql(f"PRAGMA user_version={number}")
+        print(f"[migrations] applied {number} {step.__name__}")
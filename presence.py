@@ -0,0 +1,59 @@
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Any, Dict, Optional, Set
+
+
+class PresenceHub:
+    """
+    Fans clock-in/clock-out events out to every connected presence stream.
+
+    Writers publish from the threadpool or the scheduler thread, so events are
+    handed to the event loop with call_soon_threadsafe. A subscriber that
+    falls too far behind gets a "resync" event instead of an unbounded queue.
+    """
+
+    def __init__(self, queue_size: int = 100):
+        self.queue_size = queue_size
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queues: Set[asyncio.Queue] = set()
+
+    def bind(self, loop: asyncio.AbstractEventLoop):
+        self._loop = loop
+
+    def publish(self, event: Dict[str, Any]):
+        if self._loop is None or not self._queues:
+            return
+        self._loop.call_soon_threadsafe(self._fanout, event)
+
+    def _fanout(self, event: Dict[str, Any]):
+        for queue in self._queues:
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait({"type": "resync"})
+
+    @asynccontextmanager
+    async def subscribe(self):
+        queue = asyncio.Queue(self.queue_size)
+        self._queues.add(queue)
+        try:
+            yield queue
+        finally:
+            self._queues.discard(queue)
+
+    def subscribers(self) -> int:
+        return len(self._queues)
+
+
+hub = PresenceHub()
+
+
+def clocked_in(user: int, name: str, at: datetime):
+    hub.publish({"type": "in", "user": user, "name": name, "at": at.isoformat()})
+
+
+def clocked_out(user: int):
+    hub.publish({"type": "out", "user": user})
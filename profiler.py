@@ -0,0 +1,205 @@
+from collections import defaultdict
+from contextvars import ContextVar
+import os
+from threading import Lock, get_ident
+import threading
+import time
+from typing import Dict, Optional, Tuple
+from urllib.parse import parse_qs
+
+# innermost matching frame decides the stage, so SQL run from inside a
+# template counts as sql
+STAGES = (
+    ("sql", ("sqlalchemy", "sqlmodel", "sqlite3")),
+    ("timeline", ("timeline", "aggregate", "bucketing")),
+    ("jinja", ("jinja2", "starlette.templating")),
+)
+
+
+def frame_label(frame) -> str:
+    code = frame.f_code
+    # compiled templates have no __name__, label them by file instead
+    module = frame.f_globals.get("__name__") or os.path.basename(code.co_filename)
+    return f"{module}:{code.co_qualname}"
+
+
+def stage_of(module: str) -> Optional[str]:
+    if module.endswith(".html"):
+        return "jinja"
+    for stage, prefixes in STAGES:
+        for prefix in prefixes:
+            if module == prefix or module.startswith(prefix + "."):
+                return stage
+    return None
+
+
+class Profile:
+    """
+    Samples the stacks of one request. The profile hook fires on every call
+    and return in the request's context, whichever thread runs it, and every
+    `interval` seconds of that thread's CPU time the current stack is charged
+    with the time since the previous sample. Threads sitting idle in between
+    aren't charged, so this is CPU time; SQL time as the clock sees it is in
+    the metrics.
+    """
+
+    def __init__(self, interval: float = 0.001):
+        self.interval = interval
+        self.stacks: Dict[Tuple[str, ...], float] = defaultdict(float)
+        self.stages: Dict[str, float] = defaultdict(float)
+        self.started = time.perf_counter()
+        self.seconds = 0.0
+        self.active = True
+        self._last: Dict[int, float] = {}
+
+    def tick(self, frame, event: str, arg):
+        now = time.thread_time()
+        thread = get_ident()
+        last = self._last.get(thread)
+        if last is None:
+            self._last[thread] = now
+            return
+        elapsed = now - last
+        if elapsed < self.interval:
+            return
+        self._last[thread] = now
+
+        stack = []
+        if event == "c_return" or event == "c_exception":
+            stack.append(f"{getattr(arg, '__module__', None) or 'builtins'}:{arg.__qualname__}")
+        stage = None
+        while frame is not None:
+            label = frame_label(frame)
+            if stage is None:
+                stage = stage_of(label.partition(":")[0])
+            stack.append(label)
+            frame = frame.f_back
+        stack.reverse()
+        self.stacks[tuple(stack)] += elapsed
+        self.stages[stage or "other"] += elapsed
+
+    def finish(self):
+        if self.active:
+            self.active = False
+            self.seconds = time.perf_counter() - self.started
+
+    def folded(self) -> str:
+        """Collapsed stacks in microseconds, as flamegraph.pl and speedscope read them."""
+        return "".join(
+            f"{';'.join(stack)} {round(seconds * 1e6)}\n"
+            for stack, seconds in sorted(self.stacks.items())
+        )
+
+    def server_timing(self) -> str:
+        timings = [f"{stage};dur={self.stages[stage] * 1000:.1f}" for stage in sorted(self.stages)]
+        timings.append(f"total;dur={self.seconds * 1000:.1f}")
+        return ", ".join(timings)
+
+
+current_profile: ContextVar[Optional[Profile]] = ContextVar("current_profile", default=None)
+
+_active = 0
+_lock = Lock()
+
+
+def _hook(frame, event, arg):
+    profile = current_profile.get()
+    if profile is not None and profile.active:
+        profile.tick(frame, event, arg)
+
+
+def _install():
+    global _active
+    with _lock:
+        _active += 1
+        if _active == 1:
+            threading.setprofile_all_threads(_hook)
+
+
+def _uninstall():
+    global _active
+    with _lock:
+        _active -= 1
+        if _active == 0:
+            threading.setprofile_all_threads(None)
+
+
+def profiling() -> bool:
+    return current_profile.get() is not None
+
+
+def wants_profile(scope) -> bool:
+    if b"profile" in scope["query_string"] and "profile" in parse_qs(scope["query_string"].decode()):
+        return True
+    return any(name == b"x-profile" for name, _ in scope["headers"])
+
+
+class ProfileMiddleware:
+    """
+    `?profile=1` or an `X-Profile` header on an admin's request runs it under
+    a Profile and answers with the collapsed stacks instead of the page, with
+    the time per stage in Server-Timing. Nothing is hooked otherwise. Event
+    streams never finish, so one is passed through unprofiled as soon as
+    its headers show up.
+
+    Has to sit inside AuthenticationMiddleware to see who is asking.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or not wants_profile(scope)
+            or "admin" not in scope["auth"].scopes
+        ):
+            return await self.app(scope, receive, send)
+
+        # a 304 wouldn't run anything worth profiling. Changed in place, the
+        # metrics middleware outside needs to see the route routing sets
+        scope["headers"] = [(k, v) for k, v in scope["headers"] if k != b"if-none-match"]
+
+        profile = Profile()
+        status = 500
+        streaming = False
+
+        def stop():
+            if profile.active:
+                profile.finish()
+                _uninstall()
+
+        async def capture(message):
+            nonlocal status, streaming
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                content_type = dict(message.get("headers", [])).get(b"content-type", b"")
+                if content_type.startswith(b"text/event-stream"):
+                    stop()
+                    streaming = True
+            if streaming:
+                await send(message)
+
+        token = current_profile.set(profile)
+        _install()
+        try:
+            await self.app(scope, receive, capture)
+        finally:
+            stop()
+            current_profile.reset(token)
+        if streaming:
+            return
+
+        body = profile.folded().encode()
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/plain; charset=utf-8"),
+                (b"content-length", str(len(body)).encode()),
+                (b"cache-control", b"no-store"),
+                (b"server-timing", profile.server_timing().encode()),
+                (b"x-profile-status", str(status).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,98 @@
+from concurrent.futures import Future
+import hashlib
+from threading import Lock
+from typing import Any, Callable, Dict, Hashable, Tuple
+
+from sqlmodel import Session, select
+
+from cache import TTLCache
+from db import DataVersion
+import profiler
+
+USERS = "users"
+
+
+def year_scope(year: int) -> str:
+    return f"year:{year}"
+
+
+def data_version(session: Session, *scopes: str) -> Tuple[int, ...]:
+    """
+    Current version of each scope. Read before the report data so a write
+    landing in between can only make a cache entry newer than its key.
+    """
+    versions = dict(
+        session.exec(
+            select(DataVersion.scope, DataVersion.version).where(DataVersion.scope.in_(scopes))
+        ).all()
+    )
+    return tuple(versions.get(scope, 0) for scope in scopes)
+
+
+def etag(key: Hashable) -> str:
+    return '"' + hashlib.sha1(repr(key).encode()).hexdigest()[:20] + '"'
+
+
+def etag_matches(if_none_match: str, tag: str) -> bool:
+    """
+    Whether an If-None-Match header lists `tag`. Compared whole and weakly
+    (W/"x" matches "x"), as If-None-Match is specified to.
+    """
+    tag = tag.removeprefix("W/")
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == tag:
+            return True
+    return False
+
+
+class ReportCache:
+    """
+    Computed report bodies keyed on (endpoint, year, format, data versions).
+
+    A write bumps the data version, so old entries are never served again and
+    just age out of the LRU. Concurrent requests for the same missing key wait
+    for the first one's computation instead of all running it.
+    """
+
+    def __init__(self, maxsize: int = 64, ttl: float = 24 * 60 * 60):
+        self.computed = 0
+        self._cache = TTLCache(maxsize, ttl)
+        self._inflight: Dict[Hashable, Future] = {}
+        self._lock = Lock()
+
+    def get(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        if profiler.profiling():
+            return compute()
+        with self._lock:
+            value = self._cache.get(key)
+            if value is not None:
+                return value
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+        if not owner:
+            return future.result()
+
+        try:
+            value = compute()
+            self.computed += 1
+            self._cache.set(key, value)
+            future.set_result(value)
+            return value
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        return self._cache.stats() | {"computed": self.computed}
+
+
+report_cache = ReportCache()
@@ -0,0 +1,90 @@
+from datetime import datetime
+from typing import Dict, Iterable, List, Tuple
+
+from sqlalchemy import delete, insert, tuple_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlmodel import Session, func, select
+
+from aggregate import Aggregate, split_days
+from db import Attendance, DailyTotal, engine
+
+
+def record_many(
+    session: Session, spans: Iterable[Tuple[int, datetime, datetime | None]], sign: int = 1
+) -> List[Dict]:
+    """
+    Add (or with sign=-1, remove) the time of many (user, start, end) spans in
+    one statement. Open spans (end is None) aren't part of the rollup. Doesn't
+    commit, so it lands in the same transaction as the attendance write.
+    """
+    parts = [
+        {"user": user, "day": day, "seconds": sign * duration.total_seconds()}
+        for user, start, end in spans
+        if end is not None
+        for day, duration in split_days(start, end)
+    ]
+    if not parts:
+        return parts
+
+    stmt = sqlite_insert(DailyTotal)
+    session.exec(
+        stmt.on_conflict_do_update(
+            index_elements=[DailyTotal.user, DailyTotal.day],
+            set_={"seconds": DailyTotal.seconds + stmt.excluded.seconds},
+        ),
+        params=parts,
+    )
+    if sign < 0:
+        # float drift can leave crumbs behind once a day's spans are all gone
+        session.exec(
+            delete(DailyTotal)
+            .where(
+                tuple_(DailyTotal.user, DailyTotal.day).in_(
+                    list({(p["user"], p["day"]) for p in parts})
+                )
+            )
+            .where(func.abs(DailyTotal.seconds) < 0.001)
+        )
+    return parts
+
+
+def record(session: Session, user: int, start: datetime, end: datetime | None, sign: int = 1):
+    """
+    Add (or with sign=-1, remove) a single span, see record_many
+    """
+    record_many(session, [(user, start, end)], sign)
+
+
+def rebuild(session: Session) -> int:
+    """
+    Recompute the whole rollup from the attendance table
+    """
+    spans = session.exec(
+        select(Attendance.user, Attendance.startedAt, Attendance.endedAt)
+        .where(Attendance.endedAt.isnot(None))
+    )
+    totals = Aggregate.from_rows(spans)
+    rows = [
+        {"user": user, "day": day, "seconds": duration.total_seconds()}
+        for user, days in totals.days.items()
+        for day, duration in days.items()
+    ]
+
+    session.exec(delete(DailyTotal))
+    if rows:
+        session.exec(insert(DailyTotal), params=rows)
+    session.commit()
+    return len(rows)
+
+
+def backfill_if_empty(session: Session):
+    if session.exec(select(DailyTotal).limit(1)).first() is not None:
+        return
+    if session.exec(select(Attendance).where(Attendance.endedAt.isnot(None)).limit(1)).first() is None:
+        return
+    print(f"[rollup] daily totals empty, rebuilt {rebuild(session)} rows")
+
+
+if __name__ == "__main__":
+    with Session(engine) as session:
+        print(f"Rebuilt {rebuild(session)} daily totals")
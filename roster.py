@@ -0,0 +1,101 @@
+import hashlib
+import json
+from threading import Lock
+import time
+from typing import Dict, List, NamedTuple, Optional
+
+from sqlmodel import Session, select
+
+from db import User, engine
+
+
+class RosterEntry(NamedTuple):
+    user: int
+    name: str
+    active: bool
+
+
+class Roster:
+    """
+    Warm in-memory copy of the User table for whois/name lookups.
+
+    The user handlers invalidate it after they commit. Other workers only
+    notice via a miss (an unknown id is looked up and added) or `max_age`.
+    """
+
+    def __init__(self, max_age: float = 300):
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._users: Optional[Dict[int, RosterEntry]] = None
+        self._etag = ""
+        self._loaded_at = 0.0
+        self._lock = Lock()
+
+    def load(self, session: Optional[Session] = None) -> Dict[int, RosterEntry]:
+        if session is None:
+            with Session(engine) as session:
+                return self.load(session)
+
+        users = {
+            u.user: RosterEntry(u.user, u.name, u.active)
+            for u in session.exec(select(User).order_by(User.user)).all()
+        }
+        with self._lock:
+            self._set(users)
+            self._loaded_at = time.monotonic()
+        return users
+
+    def _set(self, users: Dict[int, RosterEntry]):
+        # derived from the content so every worker agrees on it
+        body = json.dumps([list(e) for e in users.values()]).encode()
+        self._etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        self._users = users
+
+    def invalidate(self):
+        with self._lock:
+            self._users = None
+
+    def users(self) -> Dict[int, RosterEntry]:
+        users = self._users
+        if users is None or time.monotonic() - self._loaded_at > self.max_age:
+            users = self.load()
+        return users
+
+    def entries(self) -> List[RosterEntry]:
+        return list(self.users().values())
+
+    def etag(self) -> str:
+        self.users()
+        return self._etag
+
+    def get(self, userid: int, session: Optional[Session] = None) -> Optional[RosterEntry]:
+        entry = self.users().get(userid)
+        if entry is not None:
+            self.hits += 1
+            return entry
+
+        # might have been created by another worker since we loaded
+        self.misses += 1
+        if session is None:
+            with Session(engine) as session:
+                user = session.get(User, userid)
+        else:
+            user = session.get(User, userid)
+        if user is None:
+            return None
+        entry = RosterEntry(user.user, user.name, user.active)
+        with self._lock:
+            if self._users is not None:
+                self._set(self._users | {entry.user: entry})
+        return entry
+
+    def stats(self):
+        return {
+            "size": len(self._users or {}),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+roster = Roster()
@@ -0,0 +1,98 @@
+from collections import deque
+from datetime import datetime
+from threading import Lock, current_thread
+import time
+from typing import Any, List, NamedTuple
+
+from sqlalchemy import Engine, event
+
+import metrics
+
+EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+
+# parameters to these are password hashes and session ids, never shown
+SECRET_TABLES = ("authuser", "authsession")
+
+
+def shown_parameters(statement: str, parameters: Any) -> str:
+    lowered = statement.lower()
+    if any(table in lowered for table in SECRET_TABLES):
+        return "(redacted)"
+    return repr(parameters)[:500]
+
+
+class SlowQuery(NamedTuple):
+    at: datetime
+    seconds: float
+    route: str
+    statement: str
+    parameters: str
+    plan: List[str]
+
+    @property
+    def full_scan(self) -> bool:
+        # SCAN walks the whole table or index, SEARCH seeks into one
+        return any(line.lstrip().startswith("SCAN ") for line in self.plan)
+
+
+def query_plan(dbapi_connection, statement: str, parameters: Any) -> List[str]:
+    if not statement.lstrip().upper().startswith(EXPLAINABLE):
+        return []
+    try:
+        rows = dbapi_connection.execute("EXPLAIN QUERY PLAN " + statement, parameters).fetchall()
+    except Exception as e:
+        return [f"(no plan: {e})"]
+    depth = {0: -1}
+    lines = []
+    for id, parent, _, detail in rows:
+        depth[id] = depth.get(parent, -1) + 1
+        lines.append("  " * depth[id] + detail)
+    return lines
+
+
+class SlowQueryLog:
+    """
+    Ring buffer of statements that took longer than `threshold` seconds,
+    with the query plan SQLite chose for them. The plan is taken on the
+    connection that ran the statement, right after it, so it is the one
+    that was actually used.
+    """
+
+    def __init__(self, threshold: float, size: int = 200):
+        self.threshold = threshold
+        self.total = 0
+        self._entries: deque = deque(maxlen=size)
+        self._lock = Lock()
+
+    def install(self, engine: Engine):
+        @event.listens_for(engine, "before_cursor_execute")
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            context._slowlog_started = time.perf_counter()
+
+        @event.listens_for(engine, "after_cursor_execute")
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            elapsed = time.perf_counter() - context._slowlog_started
+            if elapsed < self.threshold:
+                return
+            if executemany:
+                parameters = parameters[0] if parameters else ()
+            plan = query_plan(conn.connection.dbapi_connection, statement, parameters)
+            self.record(elapsed, statement, parameters, plan)
+
+    def record(self, seconds: float, statement: str, parameters: Any, plan: List[str]):
+        stats = metrics.current_request.get()
+        route = stats.route if stats is not None else f"({current_thread().name})"
+        entry = SlowQuery(
+            datetime.now(), seconds, route, statement, shown_parameters(statement, parameters), plan
+        )
+        with self._lock:
+            self._entries.append(entry)
+            self.total += 1
+
+    def entries(self) -> List[SlowQuery]:
+        with self._lock:
+            return list(reversed(self._entries))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
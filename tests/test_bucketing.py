@@ -0,0 +1,60 @@
+from datetime import date, datetime, time, timedelta
+import random
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from bucketing import SpanArray  # noqa: E402
+from timeline import Timeline  # noqa: E402
+
+FIRST, LAST = date(2025, 1, 1), date(2025, 12, 31)
+
+
+@pytest.fixture(scope="module")
+def rows():
+    rng = random.Random(0)
+    season = datetime.combine(FIRST, time())
+    rows = []
+    for _ in range(5_000):
+        start = season + timedelta(minutes=rng.randint(0, 60 * 24 * 365))
+        # up to 30 hours, so plenty of spans cross midnight and week ends
+        rows.append((rng.randint(0, 50), start, start + timedelta(minutes=rng.randint(0, 60 * 30))))
+    return rows
+
+
+@pytest.fixture(scope="module")
+def timelines(rows):
+    timelines = {}
+    for key, start, end in rows:
+        timelines.setdefault(key, Timeline()).add(start, end)
+    return timelines
+
+
+def test_per_day_matches_timeline(rows, timelines):
+    spans = SpanArray.from_rows(rows)
+    days, totals = spans.per_day(FIRST, LAST)
+    for row, key in enumerate(spans.keys):
+        expected = [
+            timelines[key].total_day_cc(datetime.combine(day, time())).total_seconds()
+            for day in days
+        ]
+        np.testing.assert_allclose(totals[row], expected, atol=0.001)
+
+
+def test_per_week_matches_timeline(rows, timelines):
+    spans = SpanArray.from_rows(rows)
+    weeks, totals = spans.per_week(FIRST, LAST)
+    for row, key in enumerate(spans.keys):
+        expected = [
+            timelines[key].total_week_cc(datetime.combine(week, time())).total_seconds()
+            for week in weeks
+        ]
+        np.testing.assert_allclose(totals[row], expected, atol=0.001)
+
+
+def test_empty():
+    spans = SpanArray.from_rows([])
+    days, totals = spans.per_day(FIRST, FIRST)
+    assert len(days) == 1
+    assert totals.shape == (0, 1)
@@ -0,0 +1,148 @@
+import asyncio
+
+import pytest
+
+from ha import CircuitOpen, HomeAssistant, HomeAssistantError
+from ha_stub import StubHomeAssistant
+
+FANS = "switch.fans"
+
+
+@pytest.fixture
+def stub():
+    stub = StubHomeAssistant(port=0, token="secret").start()
+    yield stub
+    stub.shutdown()
+    stub.server_close()
+
+
+def client(stub, **kwargs):
+    kwargs.setdefault("backoff", 0.01)
+    return HomeAssistant(stub.url, "secret", **kwargs)
+
+
+def run(ha, coro):
+    async def main():
+        try:
+            return await coro
+        finally:
+            await ha.close()
+
+    return asyncio.run(main())
+
+
+def test_call_service(stub):
+    ha = client(stub)
+    response = run(ha, ha.call_service("switch", "turn_on", {"entity_id": FANS}))
+    assert response.status_code == 200
+    assert stub.states[FANS] == "on"
+    assert stub.calls == [("switch", "turn_on", {"entity_id": FANS})]
+
+
+def test_client_error_is_returned_not_retried(stub):
+    ha = HomeAssistant(stub.url, "wrong", backoff=0.01)
+    response = run(ha, ha.call_service("switch", "turn_on", {"entity_id": FANS}))
+    assert response.status_code == 401
+    assert ha.stats()["failures"] == 0
+
+
+def test_same_press_is_coalesced(stub):
+    stub.delay = 0.1
+    ha = client(stub)
+
+    async def presses():
+        return await asyncio.gather(
+            ha.call_service("switch", "turn_on", {"entity_id": FANS}),
+            ha.call_service("switch", "turn_on", {"entity_id": FANS}),
+            ha.call_service("switch", "turn_off", {"entity_id": FANS}),
+        )
+
+    responses = run(ha, presses())
+    assert [r.status_code for r in responses] == [200, 200, 200]
+    assert [call[1] for call in stub.calls].count("turn_on") == 1
+    assert [call[1] for call in stub.calls].count("turn_off") == 1
+    assert ha.stats()["coalesced"] == 1
+
+
+def test_failed_press_is_not_coalesced(stub):
+    stub.fail_next = 1
+    ha = client(stub, retries=0)
+
+    async def presses():
+        with pytest.raises(HomeAssistantError):
+            await ha.call_service("switch", "turn_on", {"entity_id": FANS})
+        return await ha.call_service("switch", "turn_on", {"entity_id": FANS})
+
+    assert run(ha, presses()).status_code == 200
+    assert len(stub.calls) == 2
+
+
+def test_timeout(stub):
+    stub.delay = 0.5
+    ha = client(stub, timeout=0.1, retries=0)
+    with pytest.raises(HomeAssistantError):
+        run(ha, ha.call_service("switch", "turn_on", {"entity_id": FANS}))
+
+
+def test_server_errors_are_retried(stub):
+    stub.fail_next = 2
+    ha = client(stub, retries=2)
+    response = run(ha, ha.call_service("switch", "turn_on", {"entity_id": FANS}))
+    assert response.status_code == 200
+    assert len(stub.calls) == 3
+
+
+def test_gives_up_after_retries(stub):
+    stub.fail_rate = 1
+    ha = client(stub, retries=2)
+    with pytest.raises(HomeAssistantError):
+        run(ha, ha.call_service("switch", "turn_on", {"entity_id": FANS}))
+    assert len(stub.calls) == 3
+
+
+def test_circuit_opens_and_lets_one_trial_through(stub):
+    stub.fail_rate = 1
+    ha = client(stub, retries=0, failure_threshold=2, reset_after=0.2, coalesce_window=0)
+
+    async def scenario():
+        for entity in ("switch.a", "switch.b"):
+            with pytest.raises(HomeAssistantError):
+                await ha.call_service("switch", "turn_on", {"entity_id": entity})
+        assert ha.state() == "open"
+        with pytest.raises(CircuitOpen):
+            await ha.call_service("switch", "turn_on", {"entity_id": "switch.c"})
+        assert len(stub.calls) == 2
+
+        await asyncio.sleep(0.25)
+        assert ha.state() == "half-open"
+        stub.fail_rate = 0
+        stub.delay = 0.1
+        results = await asyncio.gather(
+            *(
+                ha.call_service("switch", "turn_on", {"entity_id": f"switch.{n}"})
+                for n in range(5)
+            ),
+            return_exceptions=True,
+        )
+        assert sum(not isinstance(r, Exception) for r in results) == 1
+        assert sum(isinstance(r, CircuitOpen) for r in results) == 4
+        assert len(stub.calls) == 3
+        assert ha.state() == "closed"
+
+    run(ha, scenario())
+
+
+def test_failed_trial_reopens_circuit(stub):
+    stub.fail_rate = 1
+    ha = client(stub, retries=0, failure_threshold=1, reset_after=0.1)
+
+    async def scenario():
+        with pytest.raises(HomeAssistantError):
+            await ha.call_service("switch", "turn_on", {"entity_id": "switch.a"})
+        await asyncio.sleep(0.15)
+        assert ha.state() == "half-open"
+        with pytest.raises(HomeAssistantError):
+            await ha.call_service("switch", "turn_on", {"entity_id": "switch.b"})
+        assert ha.state() == "open"
+
+    run(ha, scenario())
@@ -0,0 +1,25 @@
+import pytest
+
+from reports import etag_matches
+
+
+@pytest.mark.parametrize("header", [
+    '"abc"',
+    'W/"abc"',
+    '"other", "abc"',
+    ' "other" ,W/"abc" ',
+    "*",
+])
+def test_etag_matches(header):
+    assert etag_matches(header, '"abc"')
+
+
+@pytest.mark.parametrize("header", [
+    "",
+    '"ab"',
+    '"abcd"',
+    '"xabc"',
+    '"other", "abcd"',
+])
+def test_etag_does_not_match(header):
+    assert not etag_matches(header, '"abc"')
@@ -1,5 +1,7 @@
+from bisect import bisect_left, bisect_right
 from datetime import datetime, timedelta
-from typing import List, NamedTuple
+from itertools import accumulate
+from typing import Iterable, List, NamedTuple
 
 
 class DateSpan(NamedTuple):
@@ -8,43 +10,101 @@ class DateSpan(NamedTuple):
 
 
 class Timeline:
-    dates: List[DateSpan]
+    """
+    Sorted interval index over a user's attendance spans.
 
-    def __init__(self):
-        self.dates = []
+    Spans are kept ordered by start time alongside a running maximum of the
+    end times and a prefix sum of durations, so range lookups are a pair of
+    binary searches plus the overlapping spans, and totals over a window
+    mostly come straight from the prefix sum.
+    """
+
+    _dates: List[DateSpan]
+
+    def __init__(self, spans: Iterable[DateSpan] = ()):
+        self._dates = [DateSpan(start, end) for start, end in spans]
+        self._dirty = True
+
+    @classmethod
+    def from_spans(cls, spans: Iterable[DateSpan]) -> "Timeline":
+        """
+        Bulk-load a timeline, sorting once instead of on every add
+        """
+        return cls(spans)
 
     def add(self, start: datetime, end: datetime):
-        self.dates.append(DateSpan(start, end))
-        self.dates.sort()
+        self._dates.append(DateSpan(start, end))
+        self._dirty = True
+
+    @property
+    def dates(self) -> List[DateSpan]:
+        self._build()
+        return self._dates
+
+    def __len__(self) -> int:
+        return len(self._dates)
+
+    def _build(self):
+        if not self._dirty:
+            return
+        self._dates.sort()
+        self._starts = [s.start for s in self._dates]
+        # ends are not sorted when spans nest, but their running max is, which
+        # is what lets us binary search for the first span reaching a point
+        self._max_ends = list(accumulate((s.end for s in self._dates), max))
+        self._durations = list(
+            accumulate((s.end - s.start for s in self._dates), initial=timedelta())
+        )
+        self._dirty = False
+
+    def _range(self, left: datetime, right: datetime) -> range:
+        """
+        Indices of the candidate spans for [left, right]; every span outside
+        this range is known not to overlap
+        """
+        self._build()
+        lo = bisect_left(self._max_ends, left)
+        hi = bisect_right(self._starts, right)
+        return range(lo, max(lo, hi))
 
     def overlapping_with(self, left: datetime, right: datetime) -> List[DateSpan]:
-        out = []
-        for start, end in self.dates:
-            # begins and ends before our window
-            if start < left and end < left:
-                continue
-            # begins and ends after our window
-            if start > right and end > right:
-                continue
-            # some part must be in our window
-            out.append(DateSpan(start, end))
-        return out
+        dates = self._dates
+        return [dates[i] for i in self._range(left, right) if dates[i].end >= left]
 
     def slice_between_cc(self, left: datetime, right: datetime) -> List[DateSpan]:
-        return list(
-            map(
-                lambda s: DateSpan(max(left, s.start), min(s.end, right)),
-                self.overlapping_with(left, right),
-            )
-        )
+        return [
+            DateSpan(max(left, s.start), min(s.end, right))
+            for s in self.overlapping_with(left, right)
+        ]
 
     def slice_between_co(self, left: datetime, right: datetime) -> List[DateSpan]:
-        return list(
-            map(
-                lambda s: DateSpan(max(left, s.start), s.end),
-                self.overlapping_with(left, right),
-            )
-        )
+        return [
+            DateSpan(max(left, s.start), s.end)
+            for s in self.overlapping_with(left, right)
+        ]
+
+    def total_between_cc(self, left: datetime, right: datetime) -> timedelta:
+        """
+        Same as summing `slice_between_cc`, without building the slices
+        """
+        candidates = self._range(left, right)
+        if not candidates:
+            return timedelta()
+
+        # spans that start inside the window and whose running max end is
+        # also inside it are fully contained, so come from the prefix sum
+        inner_lo = max(candidates.start, bisect_left(self._starts, left))
+        inner_hi = min(candidates.stop, bisect_right(self._max_ends, right))
+        inner_hi = max(inner_lo, inner_hi)
+
+        total = self._durations[inner_hi] - self._durations[inner_lo]
+        dates = self._dates
+        for i in (*range(candidates.start, inner_lo), *range(inner_hi, candidates.stop)):
+            start, end = dates[i]
+            if end < left:
+                continue
+            total += min(end, right) - max(left, start)
+        return total
 
     def _round_to_day(self, dt: datetime) -> datetime:
         return dt.replace(hour=0, minute=0, second=0, microsecond=0)
@@ -54,33 +114,31 @@ class Timeline:
             hour=0, minute=0, second=0, microsecond=0
         )
 
-    def slice_day_cc(self, dt: datetime) -> List[DateSpan]:
+    def _day_bounds(self, dt: datetime):
         day = self._round_to_day(dt)
+        return day, day + timedelta(days=1) - timedelta(microseconds=1)
 
-        return self.slice_between_cc(
-            day, day + timedelta(days=1) - timedelta(microseconds=1)
-        )
-
-    def slice_week_cc(self, dt: datetime) -> List[DateSpan]:
+    def _week_bounds(self, dt: datetime):
         day = self._round_to_week(dt)
+        return day, day + timedelta(days=7) - timedelta(microseconds=1)
 
-        return self.slice_between_cc(
-            day, day + timedelta(days=7) - timedelta(microseconds=1)
-        )
+    def slice_day_cc(self, dt: datetime) -> List[DateSpan]:
+        return self.slice_between_cc(*self._day_bounds(dt))
+
+    def slice_week_cc(self, dt: datetime) -> List[DateSpan]:
+        return self.slice_between_cc(*self._week_bounds(dt))
 
     def slice_day_co(self, dt: datetime) -> List[DateSpan]:
         """
         Slice timeline closed-open
         """
-        day = self._round_to_day(dt)
-
-        return self.slice_between_co(
-            day, day + timedelta(days=1) - timedelta(microseconds=1)
-        )
+        return self.slice_between_co(*self._day_bounds(dt))
 
     def slice_week_co(self, dt: datetime) -> List[DateSpan]:
-        day = self._round_to_week(dt)
+        return self.slice_between_co(*self._week_bounds(dt))
 
-        return self.slice_between_co(
-            day, day + timedelta(days=7) - timedelta(microseconds=1)
-        )
+    def total_day_cc(self, dt: datetime) -> timedelta:
+        return self.total_between_cc(*self._day_bounds(dt))
+
+    def total_week_cc(self, dt: datetime) -> timedelta:
+        return self.total_between_cc(*self._week_bounds(dt))